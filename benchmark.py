@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import shutil
+import datetime
+import platform
+import tempfile
+import subprocess
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+from syntheticData import writeNytCsvs, writeCdphCorpus, bayAreaCounties
+from benchmarkCdphParser import loadCorpus
+from cdphParser import parseRelease
+from cdphStore import CdphStore
+from getCdphData import CdphCovidData
+from nytData import NytData
+from plotNytData import plotUnitedStates, plotCalifornia
+from derivedMetrics import NytMetrics
+from instrumentation import peakRssMB
+
+
+# Each stage is set up from a work directory (not timed) and returns a function that runs
+# the timed work and returns the number of rows or pages it processed. NYT stages run once
+# per data scale, CDPH stages once.
+
+def nytLoadCsv(workPath, scale, tempPath):
+    def run():
+        nytData = NytData(os.path.join(workPath, f'nyt-{scale}x'), useCache=False)
+        nytData.loadSource()
+        return len(nytData.countiesData) + len(nytData.statesData)
+    return run
+
+def nytCachePath(workPath, scale):
+    # Binary caches are built once by prepareCaches, outside the measured processes
+    return os.path.join(workPath, f'nyt-{scale}x', 'cache')
+
+def prepareCaches(workPath, scales):
+    for scale in scales:
+        os.makedirs(nytCachePath(workPath, scale), exist_ok=True)
+        NytData(os.path.join(workPath, f'nyt-{scale}x'), cachePath=nytCachePath(workPath, scale)).loadSource()
+
+def loadedNytData(workPath, scale, tempPath):
+    nytData = NytData(os.path.join(workPath, f'nyt-{scale}x'), cachePath=nytCachePath(workPath, scale))
+    nytData.loadSource()
+    return nytData
+
+def nytLoadCache(workPath, scale, tempPath):
+    def run():
+        nytData = loadedNytData(workPath, scale, tempPath)
+        return len(nytData.countiesData) + len(nytData.statesData)
+    return run
+
+def nytStatesSum(workPath, scale, tempPath):
+    nytData = loadedNytData(workPath, scale, tempPath)
+    def run():
+        nytData.getStatesSum()
+        nytData.getStatesSum(['California', 'New York', 'Washington'])
+        return 2 * len(nytData.statesData)
+    return run
+
+def nytCountiesSum(workPath, scale, tempPath):
+    nytData = loadedNytData(workPath, scale, tempPath)
+    def run():
+        nytData.getCountiesSum(bayAreaCounties, 'California')
+        nytData.getCounty('Los Angeles', 'California')
+        return len(nytData.countiesData)
+    return run
+
+def nytStreamingSum(workPath, scale, tempPath):
+    nytData = NytData(os.path.join(workPath, f'nyt-{scale}x'), streaming=True)
+    def run():
+        return len(nytData.getCountiesSum(bayAreaCounties, 'California'))
+    return run
+
+def nytCube(workPath, scale, tempPath):
+    nytData = NytData(os.path.join(workPath, f'nyt-{scale}x'), useCache=False)
+    nytData.loadSource()
+    def run():
+        cube = nytData.getCube('counties')
+        return cube.cases.size
+    return run
+
+def renderNytFigures(workPath, scale, tempPath):
+    nytData = loadedNytData(workPath, scale, tempPath)
+    states = ['California', 'New York', 'New Jersey', 'Washington', 'Florida', 'Louisiana', 'Michigan', 'Georgia']
+    data = {'metrics': NytMetrics(nytData, datetime.datetime(2020, 2, 22)), 'states': states,
+            'bayArea': tuple(('California', county) for county in bayAreaCounties), 'counties': bayAreaCounties}
+    def run():
+        for function in [plotUnitedStates, plotCalifornia]:
+            plt.close(function(data, tempPath))
+        return 2
+    return run
+
+def cdphParse(workPath, scale, tempPath, backend=None):
+    pages = loadCorpus(None, os.path.join(workPath, 'cdph'))
+    def run():
+        for page in pages:
+            parseRelease(page, backend)
+        return len(pages)
+    return run
+
+def cdphParseHtmlParser(workPath, scale, tempPath):
+    return cdphParse(workPath, scale, tempPath, 'html.parser')
+
+def cdphRecords(workPath):
+    pages = loadCorpus(None, os.path.join(workPath, 'cdph'))
+    records = [parseRelease(page) for page in pages]
+    return {f'https://www.cdph.ca.gov/Programs/OPA/Pages/{record["releaseNumber"]}.aspx': record for record in records}
+
+def cdphDataToNumpy(workPath, scale, tempPath):
+    # The array is cached, so each run replaces the records to time building it
+    cdphData = CdphCovidData()
+    records = cdphRecords(workPath)
+    def run():
+        cdphData.setData(records)
+        return len(cdphData.dataToNumpy())
+    return run
+
+def cdphStoreToNumpy(workPath, scale, tempPath):
+    store = CdphStore(os.path.join(tempPath, 'califData.sqlite'))
+    store.putRecords(cdphRecords(workPath))
+    def run():
+        return len(store.toNumpy())
+    return run
+
+nytStages = {'nytLoadCsv': nytLoadCsv, 'nytLoadCache': nytLoadCache, 'nytStatesSum': nytStatesSum, 'nytCountiesSum': nytCountiesSum,
+             'nytStreamingSum': nytStreamingSum, 'nytCube': nytCube, 'renderNytFigures': renderNytFigures}
+cdphStages = {'cdphParse': cdphParse, 'cdphParseHtmlParser': cdphParseHtmlParser, 'cdphDataToNumpy': cdphDataToNumpy,
+              'cdphStoreToNumpy': cdphStoreToNumpy}
+stages = dict(nytStages, **cdphStages)
+
+def runStage(name, workPath, scale, repeat):
+    # Run in a fresh process (see runSuite) so that the peak RSS belongs to this stage
+    tempPath = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        run = stages[name](workPath, scale, tempPath)
+        setupRss = peakRssMB()
+        wallTimes, cpuTimes = [], []
+        for i in range(repeat):
+            wallStart, cpuStart = time.perf_counter(), time.process_time()
+            rows = run()
+            wallTimes.append(time.perf_counter() - wallStart)
+            cpuTimes.append(time.process_time() - cpuStart)
+    finally:
+        shutil.rmtree(tempPath, ignore_errors=True)
+    return {'stage': name, 'scale': scale, 'repeat': repeat, 'wall': min(wallTimes), 'wallMedian': float(np.median(wallTimes)),
+            'cpu': min(cpuTimes), 'rows': rows, 'rowsPerSecond': rows / min(wallTimes) if min(wallTimes) > 0 else None,
+            'setupRssMB': setupRss, 'peakRssMB': peakRssMB()}
+
+def gitCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def runSuite(workPath, scales, names, repeat, timeout):
+    results = []
+    for name in names:
+        for scale in (scales if name in nytStages else [None]):
+            label = name if scale is None else f'{name} ({scale}x)'
+            command = [sys.executable, os.path.abspath(__file__), '--workPath', workPath, '--runStage', name, '--repeat', str(repeat)]
+            if scale is not None:
+                command += ['--scale', str(scale)]
+            try:
+                process = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+                if process.returncode == 0:
+                    result = json.loads(process.stdout.strip().splitlines()[-1])
+                else:
+                    result = {'stage': name, 'scale': scale, 'error': process.stderr.strip().splitlines()[-1] if process.stderr.strip() else f'exit code {process.returncode}'}
+            except subprocess.TimeoutExpired:
+                result = {'stage': name, 'scale': scale, 'error': f'timed out after {timeout} s'}
+            if 'error' in result:
+                print(f'{label:32s} FAILED: {result["error"]}')
+            else:
+                print(f'{label:32s} {result["wall"]*1000:10.1f} ms  cpu {result["cpu"]*1000:10.1f} ms  peak {result["peakRssMB"]:7.1f} MB')
+            results.append(result)
+    return results
+
+def compareResults(results, baseline):
+    # Wall time and peak memory relative to a previous results file
+    base = {(result['stage'], result['scale']): result for result in baseline['results'] if 'error' not in result}
+    print(f'\nCompared to {baseline.get("commit")} ({baseline.get("date")}):')
+    for result in results:
+        key = (result['stage'], result['scale'])
+        if 'error' in result or key not in base:
+            continue
+        label = result['stage'] if result['scale'] is None else f'{result["stage"]} ({result["scale"]}x)'
+        print(f'{label:32s} time {result["wall"]/base[key]["wall"]:6.2f}x  memory {result["peakRssMB"]/base[key]["peakRssMB"]:6.2f}x')
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Time and memory-profile the loading, query, parsing and rendering stages on synthetic data')
+    parser.add_argument('--workPath', default='./benchmarkData', help='Directory for the synthetic data')
+    parser.add_argument('--scales', default='1,10', help='Comma separated NYT data scales, e.g. 1,10,100')
+    parser.add_argument('--stages', default=None, help='Comma separated stages to run (default: all): ' + ', '.join(stages))
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per stage; the fastest is reported')
+    parser.add_argument('--timeout', type=float, default=1800, help='Seconds before a stage is abandoned')
+    parser.add_argument('--output', default=None, help='Results JSON file (default: benchmarkResults/<commit>.json)')
+    parser.add_argument('--compare', default=None, help='Previous results JSON file to compare against')
+    parser.add_argument('--runStage', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--scale', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.runStage:
+        print(json.dumps(runStage(args.runStage, args.workPath, args.scale, args.repeat)))
+        raise SystemExit
+
+    scales = [int(scale) for scale in args.scales.split(',')]
+    names = args.stages.split(',') if args.stages else list(stages)
+    for name in names:
+        if name not in stages:
+            raise SystemExit(f'Unknown stage: {name}')
+    for scale in scales:
+        writeNytCsvs(os.path.join(args.workPath, f'nyt-{scale}x'), scale)
+    writeCdphCorpus(os.path.join(args.workPath, 'cdph'))
+    prepareCaches(args.workPath, scales)
+
+    commit = gitCommit()
+    results = runSuite(args.workPath, scales, names, args.repeat, args.timeout)
+    output = {'commit': commit, 'date': datetime.datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+              'numpy': np.__version__, 'machine': platform.platform(), 'cpus': os.cpu_count(), 'results': results}
+    filename = args.output or os.path.join('benchmarkResults', f'{commit or "results"}.json')
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'wt') as f:
+        json.dump(output, f, indent=1)
+    print(f'\nResults written to {filename}')
+
+    if args.compare:
+        with open(args.compare, 'rt') as f:
+            compareResults(results, json.load(f))
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import importlib.util
+
+from cdphStore import CdphStore
+from cdphParser import parseRelease
+
+
+def loadCorpus(dataPath, htmlPath=None):
+    # Release pages saved in the CDPH store, or *.html/*.aspx files in htmlPath
+    if htmlPath:
+        pages = []
+        for filename in sorted(os.listdir(htmlPath)):
+            if filename.endswith('.html') or filename.endswith('.aspx'):
+                with open(os.path.join(htmlPath, filename), 'rb') as f:
+                    pages.append(f.read())
+        return pages
+    store = CdphStore(os.path.join(dataPath, 'califData.sqlite'))
+    pages = [store.getPage(url) for url in store.pageUrls()]
+    store.close()
+    return pages
+
+def benchmark(pages, backend, repeat=3):
+    # Best of repeat runs, in seconds per page
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        for page in pages:
+            parseRelease(page, backend)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(pages)
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataPath', default='./data')
+    parser.add_argument('--htmlPath', default=None, help='Directory of saved release pages to use instead of the CDPH store')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    pages = loadCorpus(args.dataPath, args.htmlPath)
+    if not pages:
+        raise SystemExit('No saved release pages found!')
+    print(f'{len(pages)} release pages, {sum(len(page) for page in pages)/len(pages)/1024:.1f} kB on average')
+    for backend in ['html.parser', 'lxml']:
+        if backend == 'lxml' and importlib.util.find_spec('lxml') is None:
+            print('lxml: not installed')
+            continue
+        print(f'{backend}: {benchmark(pages, backend, args.repeat)*1000:.2f} ms per page')
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+import re
+import datetime
+import unicodedata
+import importlib.util
+
+from bs4 import BeautifulSoup, NavigableString, Comment
+from bs4.dammit import EncodingDetector
+
+# lxml is an optional, much faster HTML parser backend. Any other backend name is passed
+# on to BeautifulSoup.
+if importlib.util.find_spec('lxml'):
+    import lxml.html
+    defaultBackend = 'lxml'
+else:
+    defaultBackend = 'html.parser'
+
+
+# On 2020-04-23, the CDPH switched from reporting individual persons who have been tested
+# to reporting each test conducted. See https://www.cdph.ca.gov/Programs/OPA/Pages/NR20-062.aspx
+allTestsReportedDate = datetime.datetime(2020, 4, 23)
+
+def compileRule(blockRegex, valueRegex):
+    # Words in the block pattern may be separated by any whitespace in the page
+    return re.compile(r'\s+'.join(blockRegex.split(' '))), re.compile(valueRegex)
+
+# Ordered extractors per field: the value is taken from the first block (paragraph) of
+# the release that matches the block pattern, and the first rule that yields a value wins.
+# Rules with a date window only apply to releases dated before/since that date.
+extractors = [
+    # Cases and deaths in the confirmed cases paragraph, or listed as "# - Positive cases"/"# - Deaths"
+    {'field': 'cases', 'rule': compileRule('confirmed cases', '[0-9,]+ confirmed cases.')},
+    {'field': 'cases', 'rule': compileRule('Positive cases', '[0-9,]+...Positive cases')},
+    {'field': 'deaths', 'rule': compileRule('confirmed cases', '[0-9,]+ deaths')},
+    {'field': 'deaths', 'rule': compileRule('[0-9,]+...Death', '[0-9,]+...Death')},
+    # On 2020-05-17, the CDPH changed the wording of their news releases for test results
+    {'field': 'testsConducted', 'rule': compileRule('tests (had|have) been conducted', '[0-9,+*]+ tests (had|have) been conducted')},
+    {'field': 'testsConducted', 'rule': compileRule('[0-9,+*]+ tests conducted in California', '[0-9,+*]+ tests conducted in California')},
+    {'field': 'testsReceived', 'rule': compileRule('results have been received', '[0-9,+*]+ results have been received'), 'before': allTestsReportedDate},
+    {'field': 'testsPending', 'rule': compileRule('results have been received', '[0-9,+*]+ are pending'), 'before': allTestsReportedDate},
+]
+
+datePattern = re.compile(r'Date:\s*([A-Za-z]+)\s+([0-9]{1,2}),?\s+([0-9]{4})')
+releaseNumberPattern = re.compile(r'Number:\s*(\S+)')
+badCharPattern = re.compile('[+*,]')
+
+class ParseError(Exception):
+    pass
+
+def normalize(text):
+    return ' '.join(unicodedata.normalize('NFKD', text).split())
+
+def flattenSoup(soup):
+    # One (strings, text) pair per element that directly holds text, in document order,
+    # normalized once. strings are the element's own text nodes, which the block patterns
+    # are matched against; text is the element's whole line, which values are read from.
+    # Spans are treated as part of their parent and <br> as a space; any other child
+    # contributes to text only if it holds a single string.
+    blocks = []
+
+    def collect(element, strings, parts, children):
+        for child in element.children:
+            if isinstance(child, Comment):
+                continue
+            if isinstance(child, NavigableString):
+                strings.append(str(child))
+                parts.append(str(child))
+            elif child.name == 'span':
+                collect(child, strings, parts, children)
+            else:
+                if child.name == 'br':
+                    parts.append(' ')
+                elif child.string is not None:
+                    parts.append(child.string)
+                children.append(child)
+
+    def visit(element):
+        strings = []
+        parts = []
+        children = []
+        collect(element, strings, parts, children)
+        strings = [normalize(string) for string in strings if not string.isspace()]
+        if strings:
+            blocks.append((strings, normalize(''.join(parts))))
+        for child in children:
+            visit(child)
+
+    visit(soup)
+    return blocks
+
+def elementString(element):
+    # lxml equivalent of BeautifulSoup's Tag.string: the text of an element that holds a
+    # single string, possibly through a chain of single children
+    while True:
+        children = list(element)
+        if not children:
+            return element.text
+        if len(children) > 1 or element.text or children[0].tail or not isinstance(children[0].tag, str):
+            return None
+        element = children[0]
+
+def flattenLxml(root):
+    # flattenSoup for a document parsed directly with lxml, which avoids building a
+    # BeautifulSoup tree. Text directly inside an element is its .text and its
+    # children's .tail.
+    blocks = []
+
+    def collect(element, strings, parts, children):
+        if element.text:
+            strings.append(element.text)
+            parts.append(element.text)
+        for child in element:
+            if isinstance(child.tag, str):
+                if child.tag == 'span':
+                    collect(child, strings, parts, children)
+                else:
+                    if child.tag == 'br':
+                        parts.append(' ')
+                    else:
+                        string = elementString(child)
+                        if string is not None:
+                            parts.append(string)
+                    children.append(child)
+            if child.tail:
+                strings.append(child.tail)
+                parts.append(child.tail)
+
+    def visit(element):
+        strings = []
+        parts = []
+        children = []
+        collect(element, strings, parts, children)
+        strings = [normalize(string) for string in strings if not string.isspace()]
+        if strings:
+            blocks.append((strings, normalize(''.join(parts))))
+        for child in children:
+            visit(child)
+
+    visit(root)
+    return blocks
+
+def leadingNumber(text, pattern):
+    match = pattern.search(text)
+    if not match:
+        return None
+    try:
+        return int(badCharPattern.sub('', match[0]).split(' ')[0])
+    except ValueError:
+        raise ParseError(f'Invalid number: {match[0]}')
+
+def extract(blocks, releaseDate):
+    record = {'cases': None, 'deaths': None, 'testsConducted': None, 'testsReceived': None, 'testsPending': None}
+    for extractor in extractors:
+        if record[extractor['field']] is not None:
+            continue
+        if 'before' in extractor and releaseDate >= extractor['before']:
+            continue
+        blockPattern, valuePattern = extractor['rule']
+        for strings, text in blocks:
+            if any(blockPattern.search(string) for string in strings):
+                record[extractor['field']] = leadingNumber(text, valuePattern)
+                break
+
+    # Once every test is reported, all tests conducted count as received
+    if record['testsConducted'] is not None and releaseDate >= allTestsReportedDate:
+        record['testsReceived'] = record['testsConducted']
+        record['testsPending'] = 0
+    return record
+
+def findFirst(blocks, pattern):
+    for strings, text in blocks:
+        for string in strings:
+            match = pattern.search(string)
+            if match:
+                return match
+
+def parseRelease(html, backend=None):
+    # Parse a news release page into a record (without checking which counts were found).
+    # Pass the raw bytes of the page: they are decoded as the page declares, whatever
+    # the HTTP headers say, so a live page and its archived copy parse the same.
+    backend = backend or defaultBackend
+    if backend == 'lxml':
+        if isinstance(html, str):
+            html, encoding = html.encode('utf-8'), 'utf-8'
+        else:
+            encoding = EncodingDetector.find_declared_encoding(html, is_html=True) or 'utf-8'
+        blocks = flattenLxml(lxml.html.document_fromstring(html, parser=lxml.html.HTMLParser(encoding=encoding)))
+    else:
+        blocks = flattenSoup(BeautifulSoup(html, backend))
+
+    match = findFirst(blocks, datePattern)
+    if not match:
+        raise ParseError('Failed to find the release date!')
+    try:
+        releaseDate = datetime.datetime.strptime(' '.join(match.groups()), '%B %d %Y')
+    except ValueError:
+        raise ParseError(f'Invalid release date: {match[0]}')
+
+    match = findFirst(blocks, releaseNumberPattern)
+    if not match:
+        raise ParseError('Failed to find the release number!')
+
+    record = {'releaseDate': releaseDate, 'releaseNumber': match[1]}
+    record.update(extract(blocks, releaseDate))
+    return record
+
+def checkRecord(record):
+    # Raises ParseError if the release is unusable, otherwise returns a list of warnings
+    if record['cases'] is None:
+        raise ParseError('Failed to find the number of cases!')
+    warnings = []
+    if record['deaths'] is None:
+        warnings.append('failed to find the number of deaths!')
+    return warnings
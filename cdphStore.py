@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import zlib
+import sqlite3
+import datetime
+
+import numpy as np
+
+
+recordFields = ['releaseDate', 'releaseNumber', 'cases', 'deaths', 'testsConducted', 'testsReceived', 'testsPending']
+countFields = ['cases', 'deaths', 'testsConducted', 'testsReceived', 'testsPending']
+# Columnar layout of the records, in date order with missing counts as NaN
+cdphDtype = [('date', 'datetime64[us]')] + [(field, 'f8') for field in countFields]
+
+class CdphStore(object):
+    # SQLite store of the parsed CDPH news releases, one typed row per release, with the
+    # raw release pages kept zlib compressed in a separate table
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS releases (
+                url TEXT PRIMARY KEY,
+                releaseDate TEXT NOT NULL,
+                releaseNumber TEXT,
+                cases INTEGER,
+                deaths INTEGER,
+                testsConducted INTEGER,
+                testsReceived INTEGER,
+                testsPending INTEGER);
+            CREATE INDEX IF NOT EXISTS releasesByDate ON releases (releaseDate);
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                html BLOB NOT NULL);
+            ''')
+
+    def close(self):
+        self.connection.close()
+
+    def putRecords(self, records, pages=None):
+        # records: {url: record}, pages: {url: raw html bytes}
+        with self.connection:
+            self.connection.executemany(f'INSERT OR REPLACE INTO releases (url, {", ".join(recordFields)}) VALUES ({", ".join(["?"]*(len(recordFields)+1))})',
+                [(url, record['releaseDate'].isoformat(), *[record[field] for field in recordFields[1:]]) for url, record in records.items()])
+            if pages:
+                self.connection.executemany('INSERT OR REPLACE INTO pages (url, html) VALUES (?, ?)',
+                    [(url, zlib.compress(html)) for url, html in pages.items()])
+
+    def getRecords(self):
+        records = {}
+        for row in self.connection.execute(f'SELECT url, {", ".join(recordFields)} FROM releases'):
+            record = dict(zip(recordFields, row[1:]))
+            record['releaseDate'] = datetime.datetime.fromisoformat(record['releaseDate'])
+            records[row[0]] = record
+        return records
+
+    def getPage(self, url):
+        row = self.connection.execute('SELECT html FROM pages WHERE url = ?', (url,)).fetchone()
+        return zlib.decompress(row[0]) if row else None
+
+    def pageUrls(self):
+        return [row[0] for row in self.connection.execute('SELECT url FROM pages')]
+
+    def toNumpy(self):
+        # Same layout as CdphCovidData.dataToNumpy, with missing values as NaN
+        rows = self.connection.execute(f'SELECT {", ".join(recordFields)} FROM releases ORDER BY releaseDate, url').fetchall()
+        output = np.zeros(len(rows), dtype=cdphDtype)
+        if rows:
+            columns = list(zip(*rows))
+            output['date'] = np.array(columns[0], dtype='datetime64[us]')
+            for field, column in zip(countFields, columns[2:]):
+                output[field] = np.array(column, dtype=float)
+        return output
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import json
+import itertools
+import hashlib
+
+import numpy as np
+
+
+# Name columns are stored as indices into a per-column lookup table
+codeType = 'u2'
+
+# Bytes read from the end of a file to find its last complete line
+tailWindow = 1 << 16
+
+def encodedDtype(dtype):
+    return [(name, codeType if fieldType.startswith('U') else fieldType) for name, fieldType in dtype]
+
+def encodeColumn(column, table=None):
+    # Codes of each name in table. Names not in table are appended to it, so the codes
+    # already handed out stay valid.
+    names, inverse = np.unique(column, return_inverse=True)
+    if table is None:
+        return names, inverse
+    lookup = {name: code for code, name in enumerate(table)}
+    newNames = [name for name in names if name not in lookup]
+    if newNames:
+        lookup.update({name: len(table) + i for i, name in enumerate(newNames)})
+        table = np.concatenate([table, np.array(newNames, dtype=table.dtype)])
+    codes = np.array([lookup[name] for name in names], dtype=codeType)
+    return table, codes[inverse]
+
+def buildRegionIndex(keys):
+    # Stable sort of the rows by region key keeps each region's rows in file (date) order.
+    # Returns the row order and, per key, the (start, stop) of its rows within that order.
+    order = np.argsort(keys, kind='stable')
+    sortedKeys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sortedKeys[1:] != sortedKeys[:-1]])
+    stops = np.r_[starts[1:], len(sortedKeys)]
+    return order, {int(sortedKeys[start]): (start, stop) for start, stop in zip(starts, stops)}
+
+def decodeRows(data, tables, dtype):
+    output = np.empty(len(data), dtype=dtype)
+    for name in output.dtype.names:
+        output[name] = tables[name][data[name]] if name in tables else data[name]
+    return output
+
+def sumByDate(data, dates, dateIdx, idx=None, startDate=None):
+    # Accumulate cases and deaths of the selected rows into their dates in a single pass.
+    # dates/dateIdx are np.unique(data['date'], return_inverse=True); the output covers
+    # every date in the table, with zeros where none of the selected rows report.
+    output = np.zeros(len(dates), dtype=[('date', 'datetime64[us]'), ('cases', 'i4'), ('deaths', 'i4')])
+    output['date'] = dates
+    if idx is not None:
+        dateIdx = dateIdx[idx]
+    for field in ['cases', 'deaths']:
+        values = data[field] if idx is None else data[field][idx]
+        output[field] = np.bincount(dateIdx, weights=values, minlength=len(dates))
+    if startDate:
+        output = output[output['date'] >= startDate]
+    return output
+
+def readText(f, fields):
+    # Every column as text in a single pass. Numbers and dates fit in 16 characters.
+    textDtype = [(name, fieldType if fieldType.startswith('U') else 'U16') for name, fieldType in fields]
+    return np.loadtxt(f, delimiter=',', dtype=textDtype, comments=None, quotechar='"', ndmin=1)
+
+def convertNumbers(column, fieldType):
+    # Missing values (e.g. counties without a FIPS code) become 0
+    missing = column == ''
+    column[missing] = '0'
+    return column.astype(fieldType)
+
+def parseCsv(f, fields, tables=None):
+    # Read every column as text, then convert whole columns at once rather than calling
+    # a Python date parser per row. Returns the encoded rows and the (possibly extended)
+    # name lookup tables.
+    text = readText(f, fields)
+    data = np.zeros(len(text), dtype=encodedDtype(fields))
+    tables = dict(tables or {})
+    for name, fieldType in fields:
+        column = text[name]
+        if fieldType.startswith('datetime64'):
+            data[name] = column.astype('datetime64[D]')
+        elif fieldType.startswith('U'):
+            tables[name], data[name] = encodeColumn(column, tables.get(name))
+        else:
+            data[name] = convertNumbers(column, fieldType)
+    return data, tables
+
+def parseChunk(lines, fields):
+    # As parseCsv, but names stay as text
+    text = readText(lines, fields)
+    data = np.zeros(len(text), dtype=fields)
+    for name, fieldType in fields:
+        column = text[name]
+        if fieldType.startswith('datetime64'):
+            data[name] = column.astype('datetime64[D]')
+        elif fieldType.startswith('U'):
+            data[name] = column
+        else:
+            data[name] = convertNumbers(column, fieldType)
+    return data
+
+def readChunks(filename, dtype, chunkRows=20000):
+    # Decoded rows of a CSV, chunkRows at a time, so memory use is bounded by the chunk
+    # size rather than the file size. A partially written last line is skipped.
+    header, fields = readHeader(filename, dtype)
+    with open(filename, 'rt') as f:
+        f.readline()
+        while True:
+            lines = list(itertools.islice(f, chunkRows))
+            if not lines:
+                break
+            lines = [line for line in lines if line.endswith('\n') and line.strip()]
+            if lines:
+                yield parseChunk(lines, fields)
+
+def readHeader(filename, dtype):
+    with open(filename, 'rt') as f:
+        header = f.readline()
+    names = header.strip().split(',')
+    return header, [(name, fieldType) for name, (_, fieldType) in zip(names, dtype)]
+
+def loadCsv(filename, dtype):
+    # A partially written last line is left for the next load
+    header, fields = readHeader(filename, dtype)
+    with open(filename, 'rt') as f:
+        f.readline()
+        return parseCsv((line for line in f if line.endswith('\n')), fields)
+
+def completeLength(filename):
+    # Bytes up to and including the last newline
+    with open(filename, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        start = max(size - tailWindow, 0)
+        f.seek(start)
+        return start + f.read().rfind(b'\n') + 1
+
+def appendNpy(filename, rows):
+    # Grow a 1-D .npy file in place by rewriting the shape in its header and appending
+    # the raw rows. Returns False if the header would change size. The rows already in
+    # the file are not touched, so earlier memory maps of it stay valid.
+    with open(filename, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(f)
+        dataOffset = f.tell()
+        if dtype != rows.dtype or len(shape) != 1 or fortranOrder:
+            return False
+
+        header = io.BytesIO()
+        writeHeader = np.lib.format.write_array_header_1_0 if version == (1, 0) else np.lib.format.write_array_header_2_0
+        writeHeader(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (shape[0] + len(rows),)})
+        header = header.getvalue()
+        if len(header) != dataOffset:
+            return False
+
+        f.seek(dataOffset + shape[0] * dtype.itemsize)
+        f.write(np.ascontiguousarray(rows).tobytes())
+        f.truncate()
+        f.seek(0)
+        f.write(header)
+    return True
+
+def defaultCachePath(sourcePath):
+    # cache/<name> next to a source directory, e.g. data/cache/nytimes for data/nytimes.
+    # The sources are git submodules, and files written inside them would leave the
+    # submodule dirty, where the .gitignore of this repository cannot reach them.
+    sourcePath = os.path.abspath(sourcePath)
+    return os.path.join(os.path.dirname(sourcePath), 'cache', os.path.basename(sourcePath))
+
+def replaceFile(filename, write):
+    # Write a cache file as a temporary file next to it, then move that over the old one.
+    # Processes that have the old file memory mapped keep reading its contents, where
+    # rewriting it in place would change them, or crash the reader if it is truncated.
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    temp = f'{filename}.{os.getpid()}.tmp'
+    try:
+        with open(temp, 'wb') as f:
+            write(f)
+        os.replace(temp, filename)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+def hashPrefix(filename, offset):
+    # sha1 of the first offset bytes, read a block at a time
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while offset > 0:
+            block = f.read(min(offset, 1 << 20))
+            if not block:
+                break
+            h.update(block)
+            offset -= len(block)
+    return h.hexdigest()
+
+def sourceState(filename, header, offset, rowCount, lastDate):
+    # What has been ingested so far: enough to find the new tail and to tell whether the
+    # bytes before it are still the ones that were parsed
+    return {'header': header, 'offset': offset, 'rowCount': rowCount, 'lastDate': lastDate,
+            'prefixHash': hashPrefix(filename, offset)}
+
+def isAppendedTo(filename, header, state):
+    # Any change before the ingested offset (e.g. a revised count) means a rewrite
+    if state is None or state['header'] != header or os.path.getsize(filename) < state['offset']:
+        return False
+    return state.get('prefixHash') == hashPrefix(filename, state['offset'])
+
+def ingestTail(filename, fields, tables, state):
+    # Parse only the complete lines after the ingested offset
+    with open(filename, 'rb') as f:
+        f.seek(state['offset'])
+        raw = f.read()
+    end = raw.rfind(b'\n') + 1
+    lines = [line for line in raw[:end].decode('utf-8').splitlines() if line.strip()]
+    if not lines:
+        return None, tables, state['offset']
+    rows, tables = parseCsv(lines, fields, tables)
+    return rows, tables, state['offset'] + end
+
+def appendToCache(filename, header, fields, cacheFilename, tablesFilename, stateFilename, state):
+    # Returns the updated rows and tables, or None if the cache has to be rebuilt
+    with np.load(tablesFilename) as tables:
+        tables = dict(tables)
+    if len(np.load(cacheFilename, mmap_mode='r')) != state['rowCount']:
+        return None
+
+    rows, tables, offset = ingestTail(filename, fields, tables, state)
+    rowCount, lastDate = state['rowCount'], state['lastDate']
+    if rows is not None:
+        # NYT files are in date order, so new rows that go back in time mean revised history
+        if lastDate is not None and rows['date'][0] < np.datetime64(lastDate):
+            return None
+        print(f'Appending {len(rows)} new rows from {filename} ...')
+        if not appendNpy(cacheFilename, rows):
+            return None
+        rowCount += len(rows)
+        lastDate = str(rows['date'][-1].astype('datetime64[D]'))
+    replaceFile(tablesFilename, lambda f: np.savez(f, **tables))
+    writeState(stateFilename, sourceState(filename, header, offset, rowCount, lastDate))
+    return np.load(cacheFilename, mmap_mode='r'), tables
+
+def loadCachedCsv(filename, dtype, cacheFilename, sourceTime, incremental=True):
+    # Load the encoded rows and name tables of a CSV. With a cache file, the cache is
+    # memory mapped if it is newer than sourceTime; otherwise, if the CSV has only been
+    # appended to since it was cached, just the new lines are parsed and appended to the
+    # cache, and anything else (e.g. revised history) triggers a full rebuild.
+    if not cacheFilename:
+        print(f'Loading data from {filename} ...')
+        return loadCsv(filename, dtype)
+
+    base = os.path.splitext(cacheFilename)[0]
+    tablesFilename = base + '.names.npz'
+    stateFilename = base + '.ingest.json'
+    cacheFiles = [cacheFilename, tablesFilename, stateFilename]
+    if all(os.path.exists(f) and os.path.getmtime(f) >= sourceTime for f in cacheFiles):
+        print(f'Loading cached data from {cacheFilename} ...')
+        with np.load(tablesFilename) as tables:
+            tables = dict(tables)
+        return np.load(cacheFilename, mmap_mode='r'), tables
+
+    header, fields = readHeader(filename, dtype)
+    if incremental and all(os.path.exists(f) for f in cacheFiles):
+        with open(stateFilename, 'rt') as f:
+            state = json.load(f)
+        try:
+            if isAppendedTo(filename, header, state):
+                result = appendToCache(filename, header, fields, cacheFilename, tablesFilename, stateFilename, state)
+                if result is not None:
+                    return result
+                print(f'Cache of {filename} does not match the source, rebuilding ...')
+            else:
+                print(f'{filename} was rewritten, rebuilding the cache ...')
+        except (OSError, ValueError) as e:
+            print(f'WARNING - incremental load of {filename} failed ({e}), rebuilding ...')
+
+    print(f'Loading data from {filename} ...')
+    data, tables = loadCsv(filename, dtype)
+    try:
+        replaceFile(cacheFilename, lambda f: np.save(f, data))
+        replaceFile(tablesFilename, lambda f: np.savez(f, **tables))
+        lastDate = str(data['date'][-1].astype('datetime64[D]')) if len(data) else None
+        writeState(stateFilename, sourceState(filename, header, completeLength(filename), len(data), lastDate))
+    except OSError as e:
+        print(f'WARNING - failed to write cache {cacheFilename}: {e}')
+    return data, tables
+
+def writeState(filename, state):
+    replaceFile(filename, lambda f: f.write(json.dumps(state, indent=2).encode('utf-8')))
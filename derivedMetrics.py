@@ -0,0 +1,211 @@
+import os
+import csv
+import math
+import collections
+
+import numpy as np
+
+from timeSeries import rollingMean, dailyChange
+
+
+def loadPopulation(filename):
+    # {(state, county): population}, with county '' for a whole state
+    population = {}
+    with open(filename, 'rt', newline='') as f:
+        for row in csv.DictReader(f):
+            population[(row['state'], row['county'])] = int(row['population'])
+    return population
+
+def defaultPopulation(dataPath):
+    filename = os.path.join(dataPath, 'population.csv')
+    return loadPopulation(filename) if os.path.exists(filename) else {}
+
+def growthRate(cumulative, window):
+    # Average daily exponential growth rate over the last window days
+    cumulative = np.asarray(cumulative, dtype=float)
+    rate = np.full(cumulative.shape, np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rate[window:] = np.log(cumulative[window:] / cumulative[:-window]) / window
+    rate[~np.isfinite(rate)] = np.nan
+    return rate
+
+
+class DerivedMetrics(object):
+    # Metrics derived from a source's cumulative cases and deaths, aligned with its dates.
+    # Every result is memoized by (region, metric, window), keeping the maxEntries most
+    # recently used, and the whole cache is dropped when sourceVersion() changes.
+    # Subclasses provide loadSeries(region) and regionPopulation(region).
+    windowMetrics = ['newCasesAverage', 'dailyDeathsAverage', 'growthRate', 'doublingTime', 'newCasesPer100k']
+
+    def __init__(self, population=None, maxEntries=512):
+        self.population = population or {}
+        self.maxEntries = maxEntries
+        self.cache = collections.OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    def checkVersion(self):
+        version = self.sourceVersion()
+        if version != self.version:
+            self.cache.clear()
+            self.version = version
+
+    def series(self, region):
+        return self.get(region, 'series')
+
+    def dates(self, region):
+        return self.series(region)['date']
+
+    def get(self, region, metric, window=7):
+        if metric not in self.windowMetrics:
+            window = None
+        key = (region, metric, window)
+        self.checkVersion()
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.misses += 1
+        value = self.compute(region, metric, window)
+        self.store(key, value)
+        return value
+
+    def store(self, key, value):
+        self.cache[key] = value
+        while len(self.cache) > self.maxEntries:
+            self.cache.popitem(last=False)
+
+    def latest(self, region, metric, window=7):
+        # The most recent value that is not NaN
+        values = self.get(region, metric, window)
+        valid = np.flatnonzero(~np.isnan(values))
+        return values[valid[-1]] if len(valid) else float('nan')
+
+    def compute(self, region, metric, window):
+        if metric == 'series':
+            return self.loadSeries(region)
+        elif metric == 'newCases':
+            return dailyChange(self.get(region, 'cases'))
+        elif metric == 'dailyDeaths':
+            return dailyChange(self.get(region, 'deaths'))
+        elif metric == 'newCasesAverage':
+            return rollingMean(self.get(region, 'newCases'), window)
+        elif metric == 'dailyDeathsAverage':
+            return rollingMean(self.get(region, 'dailyDeaths'), window)
+        elif metric == 'growthRate':
+            return growthRate(self.get(region, 'cases'), window)
+        elif metric == 'doublingTime':
+            rate = self.get(region, 'growthRate', window)
+            return np.where(rate > 0, math.log(2) / np.where(rate > 0, rate, 1), np.nan)
+        elif metric == 'casesPer100k':
+            return self.get(region, 'cases') * 1e5 / self.regionPopulation(region)
+        elif metric == 'deathsPer100k':
+            return self.get(region, 'deaths') * 1e5 / self.regionPopulation(region)
+        elif metric == 'newCasesPer100k':
+            return self.get(region, 'newCasesAverage', window) * 1e5 / self.regionPopulation(region)
+        elif metric == 'cfr':
+            cases = self.get(region, 'cases')
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return np.where(cases > 0, self.get(region, 'deaths') / cases, np.nan)
+        series = self.series(region)
+        if metric in series.dtype.names and metric != 'date':
+            return series[metric].astype(float)
+        raise ValueError(f'Unknown metric: {metric}')
+
+
+class NytMetrics(DerivedMetrics):
+    # Regions are a state name, a (state, county) pair, a tuple of (state, county) pairs
+    # (summed; all with county '' for a set of states) or None for the whole country
+    def __init__(self, nytData, startDate=None, population=None, maxEntries=512):
+        super().__init__(population, maxEntries)
+        self.nytData = nytData
+        self.startDate = startDate
+
+    def sourceVersion(self):
+        # Streaming queries read the files, so their version is the files' mtime
+        if self.nytData.streaming:
+            return self.nytData.modificationTime()
+        return self.nytData.revision
+
+    def regionQuery(self, region):
+        # How a region is loaded: ('state', name), ('county', (state, county)), ('states',
+        # [state, ...] or None for the whole country) or ('counties', [(state, county), ...])
+        if region is None:
+            return 'states', None
+        elif isinstance(region, str):
+            return 'state', region
+        elif isinstance(region[0], str):
+            return 'county', region
+        elif not any(county for state, county in region):
+            return 'states', [state for state, county in region]
+        return 'counties', list(region)
+
+    def loadSeries(self, region):
+        kind, value = self.regionQuery(region)
+        if kind == 'state':
+            return self.nytData.getState(value, self.startDate)
+        elif kind == 'county':
+            return self.nytData.getCounty(value[1], value[0], self.startDate)
+        elif kind == 'states':
+            return self.nytData.getStatesSum(value, self.startDate)
+        return self.nytData.getRegionsSum(regions=value, startDate=self.startDate)
+
+    def prefetch(self, regions):
+        # Load the series of several regions with one query per CSV. When streaming, that
+        # is one pass over each file rather than one per region.
+        self.checkVersion()
+        queries = {'state': [], 'county': [], 'states': {}, 'counties': {}}
+        for region in regions:
+            if (region, 'series', None) in self.cache:
+                continue
+            kind, value = self.regionQuery(region)
+            if kind in ['state', 'county']:
+                queries[kind].append(value)
+            else:
+                queries[kind][region] = value
+        series = {}
+        if queries['state'] or queries['states']:
+            for output in self.nytData.queryStates(queries['state'], queries['states'], self.startDate):
+                series.update(output)
+        if queries['county'] or queries['counties']:
+            for output in self.nytData.queryCounties(queries['county'], queries['counties'], self.startDate):
+                series.update(output)
+        for region, value in series.items():
+            self.store((region, 'series', None), value)
+
+    def regionPopulation(self, region):
+        if region is None:
+            populations = [population for (state, county), population in self.population.items() if not county]
+        elif isinstance(region, str):
+            populations = [self.population.get((region, ''))]
+        elif isinstance(region[0], str):
+            populations = [self.population.get(region)]
+        else:
+            populations = [self.population.get(pair) for pair in region]
+        if not populations or None in populations:
+            return float('nan')
+        return float(sum(populations))
+
+
+class CdphMetrics(DerivedMetrics):
+    # Statewide data only, so the region is ignored (use None or 'California')
+    def __init__(self, cdphData, population=None, maxEntries=512):
+        super().__init__(population, maxEntries)
+        self.cdphData = cdphData
+
+    def sourceVersion(self):
+        return self.cdphData.revision
+
+    def loadSeries(self, region):
+        return self.cdphData.dataToNumpy()
+
+    def regionPopulation(self, region):
+        return float(self.population.get(('California', ''), float('nan')))
+
+    def compute(self, region, metric, window):
+        if metric == 'casesPerTest':
+            tests = self.get(region, 'testsReceived')
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return np.where(tests > 0, self.get(region, 'cases') / tests, np.nan)
+        return super().compute(region, metric, window)
@@ -2,26 +2,77 @@
 
 import os
 import re
+import csv
 import urllib
-import datetime
-import unicodedata
+import bisect
 import pickle
+import datetime
+from concurrent.futures import ProcessPoolExecutor
 
-import requests
 from bs4 import BeautifulSoup
 import numpy as np
 
+from webFetcher import Fetcher, ResponseCache
+from cdphStore import CdphStore, countFields, cdphDtype
+from cdphParser import parseRelease, checkRecord, ParseError
+from instrumentation import instrument, currentSpan, configure, writeReport
+
+# Per-process state of the --reparse workers
+reparseStore = None
+reparseBackend = None
+
+def initReparseWorker(storeFilename, backend):
+    global reparseStore, reparseBackend
+    reparseStore = CdphStore(storeFilename)
+    reparseBackend = backend
+
+def reparseReleases(urls):
+    # Re-run extraction on archived release pages. Returns (url, record, error, warnings)
+    # per url, so one bad page does not stop the others.
+    results = []
+    for url in urls:
+        try:
+            record = parseRelease(reparseStore.getPage(url), reparseBackend)
+            results.append((url, record, None, checkRecord(record)))
+        except Exception as e:
+            results.append((url, None, f'{type(e).__name__}: {e}', []))
+    return results
+
+def recordRow(record):
+    return (record['releaseDate'],) + tuple(np.nan if record[field] is None else record[field] for field in countFields)
+
+csvHeader = 'date,releaseNumber,' + ','.join(countFields)
+
+def csvLine(record):
+    values = ['' if record[field] is None else str(record[field]) for field in countFields]
+    return ','.join([record['releaseDate'].strftime('%Y-%m-%d'), record['releaseNumber']] + values)
+
 class CdphCovidData(object):
-    def __init__(self):
-        self.baseUrl = 'https://www.cdph.ca.gov'
+    def __init__(self, baseUrl='https://www.cdph.ca.gov', fetcher=None, backend=None):
+        self.baseUrl = baseUrl
+        self.backend = backend
         self.newsReleaseUrl = urllib.parse.urljoin(self.baseUrl, '/Programs/OPA/Pages/New-Release-2020.aspx')
+        self.fetcher = fetcher if fetcher is not None else Fetcher()
         self.data = {}
-
+        self.store = None
+        # Releases parsed since the last save, and their raw pages
+        self.unsaved = set()
+        self.pages = {}
+        # Bumped whenever self.data changes, so derived data can tell when it is stale
+        self.revision = 0
+        # (releaseDate, url) of every release in order, and the records as a structured
+        # array in the same order (built on first use). setRecord keeps both up to date.
+        self.index = []
+        self.array = None
+
+    @instrument()
     def getData(self, force=False):
-        response = requests.get(self.newsReleaseUrl)
+        requestCount, bytesFetched = self.fetcher.requests, self.fetcher.bytesFetched
+        response = self.fetcher.get(self.newsReleaseUrl)
         soup = BeautifulSoup(response.text, 'html.parser')
 
         # Get news releases - look for links with the string 'Latest COVID-19 Facts'
+        urls = []
         links = soup.find_all('a')
         for link in links:
             if link.findChild(string=re.compile('Latest COVID-19 Facts')) is None:
@@ -36,158 +87,178 @@ class CdphCovidData(object):
             if url in self.data and not force:
                 print(f'\n{url} - already parsed, skipping')
                 self.printRecord(self.data[url])
-            else:
-                print(f'\n{url}')
-                self.parseNewsRelease(url)
-
-    def parseNewsRelease(self, url):
-        response = requests.get(url)
-        soup = BeautifulSoup(response.text, 'html.parser')
-
-        for match in soup.find_all('span'):
-            match.unwrap()    
-        
-        dateStrings = soup.find_all(string=re.compile('Date:'))
-        assert len(dateStrings) == 1, 'Expect to find exactly one date string!'
-        dateString = unicodedata.normalize('NFKD', dateStrings[0])
-        dateString = dateStrings[0].split(':')[1].strip()
-        dateString = dateString.replace(',', '')
-        dateString = dateString.replace('\xa0', ' ')
-        tokens = dateString.split(' ')
-        tokens = [token.strip() for token in tokens]
-        dateString = ' '.join(tokens)
-        releaseDate = datetime.datetime.strptime(dateString, '%B %d %Y')
-        print(releaseDate)
-
-        releaseStrings = soup.find_all(string=re.compile('Number:'))
-        assert len(releaseStrings) == 1, 'Expect to find exactly one release string!'
-        releaseString = unicodedata.normalize('NFKD', releaseStrings[0])
-        release = releaseString.split(':')[1].strip()
-
-        record = {'releaseDate': releaseDate, 'releaseNumber': release, 'cases': None, 'deaths': None, 'testsConducted': None, 'testsReceived': None, 'testsPending': None, 'webResponse': response}
-        
-        # Look for cases and deaths in confirmed cases string (first paragraph)
-        strings = self.findString(soup, 'confirmed cases')
-        record['cases'] = self.getLeadingNumber(strings, '[0-9,]+ confirmed cases.')
-        record['deaths'] = self.getLeadingNumber(strings, '[0-9,]+ deaths')
-
-        # If not in first para, try looking for cases as "# - Positive cases"
-        if record['cases'] is None:
-            strings = self.findString(soup, 'Positive cases')
-            record['cases'] = self.getLeadingNumber(strings, '[0-9,]+...Positive cases')
-
-        # If not in first para, try looking for deaths as "# - Deaths"
-        if record['deaths'] is None:
-            strings = self.findString(soup, '[0-9,]+...Death')
-            record['deaths'] = self.getLeadingNumber(strings, '[0-9,]+...Death')
-
-        if record['cases'] is None:
-            print('\n****** Failed to find the number of cases!')
-            import pdb; pdb.set_trace()
-            raise Exception('Failed to find the number of cases!')
-
-        if record['deaths'] is None:
-            print('\n****** WARNING - failed to find the number of deaths!')
-        #     import pdb; pdb.set_trace()
-        #     raise Exception('Failed to find the number of deaths!')
-
-        strings = self.findString(soup, 'tests (had|have) been conducted')
-        if strings:
-            record['testsConducted'] = self.getLeadingNumber(strings, '[0-9,+*]+ tests (had|have) been conducted')
-
-            # On 2020-04-23, the CDPH switched from reporting individual persons who have been tested
-            # to reporting each test conducted. See https://www.cdph.ca.gov/Programs/OPA/Pages/NR20-062.aspx 
-            strings = self.findString(soup, 'results have been received')
-            if releaseDate < datetime.datetime(2020, 4, 23):
-                record['testsReceived'] = self.getLeadingNumber(strings, '[0-9,+*]+ results have been received')
-                record['testsPending'] = self.getLeadingNumber(strings, '[0-9,+*]+ are pending')
-            elif releaseDate >= datetime.datetime(2020, 4, 23):
-                record['testsReceived'] = record['testsConducted']
-                record['testsPending'] = 0
-        else:
-            # On 2020-05-17, the CDPH changed the wording of their news releases for test results
-            strings = self.findString(soup, '[0-9,+*]+ tests conducted in California')
-            record['testsConducted'] = self.getLeadingNumber(strings, '[0-9,+*]+ tests conducted in California')
-            record['testsReceived'] = record['testsConducted']
-            record['testsPending'] = 0
-
-        self.data[url] = record
+            elif url not in urls:
+                urls.append(url)
+
+        # Fetch the releases concurrently and parse each one as it arrives. Published releases
+        # do not change, so cached copies are used as they are.
+        failures = {}
+        for url, response, error in self.fetcher.getMany(urls, revalidate=False):
+            print(f'\n{url}')
+            if error is not None:
+                print(f'****** Failed to fetch {url}: {error}')
+                failures[url] = str(error)
+                continue
+            # As in reparseReleases, an error in one release is reported and the others are
+            # still parsed and saved
+            try:
+                self.parseNewsRelease(url, response)
+            except ParseError as e:
+                print(f'\n****** {e}')
+                failures[url] = str(e)
+            except Exception as e:
+                print(f'\n****** {type(e).__name__}: {e}')
+                failures[url] = f'{type(e).__name__}: {e}'
+        currentSpan().add(rows=len(urls), requests=self.fetcher.requests - requestCount, bytes=self.fetcher.bytesFetched - bytesFetched)
+        self.printFailures(failures)
+        return failures
+
+    @instrument()
+    def parseNewsRelease(self, url, response=None):
+        if response is None:
+            response = self.fetcher.get(url)
+        record = parseRelease(response.content, self.backend)
+        currentSpan().add(rows=1)
+        print(record['releaseDate'])
+
+        for warning in checkRecord(record):
+            print(f'\n****** WARNING - {warning}')
+
+        self.setRecord(url, record)
+        self.pages[url] = response.content
 
         self.printRecord(record)
 
-    def findString(self, soup, regex):
-        regex = '[\s]+'.join(regex.split(' '))
-        strings = soup.find_all(string=re.compile(regex))
-        if strings:
-            newStrings = []
-            for string in strings:
-                output = ''
-                for child in string.parent.children:
-                    try:
-                        if child.string is not None:
-                            output += child.string
-                        else:
-                            if child.name == 'br':
-                                output += ' '
-                    except:
-                        pass
-                newStrings.append(output)
-            strings = newStrings
-            strings = [unicodedata.normalize('NFKD', string) for string in strings]
-            strings = [' '.join(string.split()) for string in strings]
-        return strings
-
-    def getLeadingNumber(self, strings, regex):
-        if not strings:
-            return
-        badCharPattern = re.compile('[+*,]')
-        string = re.search(regex, strings[0])
-        if not string:
-            return
-        string = badCharPattern.sub('', string[0])
-        value = int(string.split(' ')[0])
-
-        return value
+    def reparse(self, path, processes=None):
+        # Re-run extraction over every release page archived in the store, spread across
+        # a process pool. Results are merged in url order, so the outcome does not depend
+        # on which worker finishes first.
+        store = self.openStore(path)
+        urls = sorted(store.pageUrls())
+        print(f'\nRe-parsing {len(urls)} archived releases from {store.filename} ...')
+        processes = processes or os.cpu_count()
+        chunkSize = max(1, len(urls) // (processes * 4))
+        chunks = [urls[i:i+chunkSize] for i in range(0, len(urls), chunkSize)]
+        failures = {}
+        with ProcessPoolExecutor(processes, initializer=initReparseWorker, initargs=(store.filename, self.backend)) as executor:
+            for results in executor.map(reparseReleases, chunks):
+                for url, record, error, warnings in results:
+                    if error is not None:
+                        failures[url] = error
+                        continue
+                    for warning in warnings:
+                        print(f'{url} - WARNING - {warning}')
+                    if self.data.get(url) != record:
+                        self.setRecord(url, record)
+        print(f'{len(self.unsaved)} releases changed')
+        self.printFailures(failures)
+        return failures
+
+    def setRecord(self, url, record):
+        # Add or replace one release (marked unsaved), moving it within the index and array
+        old = self.data.get(url)
+        if old is not None:
+            position = bisect.bisect_left(self.index, (old['releaseDate'], url))
+            del self.index[position]
+            if self.array is not None:
+                self.array = np.delete(self.array, position)
+        self.data[url] = record
+        key = (record['releaseDate'], url)
+        position = bisect.bisect_left(self.index, key)
+        self.index.insert(position, key)
+        if self.array is not None:
+            self.array = np.insert(self.array, position, np.array([recordRow(record)], dtype=cdphDtype))
+        self.unsaved.add(url)
+        self.revision += 1
+
+    def setData(self, data):
+        # Replace all releases; the array is rebuilt when next needed
+        self.data = data
+        self.index = sorted((record['releaseDate'], url) for url, record in data.items())
+        self.array = None
+        self.revision += 1
+
+    def printFailures(self, failures):
+        if failures:
+            print(f'\n****** Failed to parse {len(failures)} releases:')
+            for url in sorted(failures):
+                print(f'{url}: {failures[url]}')
+
+    def openStore(self, path):
+        if self.store is None:
+            self.store = CdphStore(os.path.join(path, 'califData.sqlite'))
+        return self.store
 
     def saveData(self, path):
-        filename = os.path.join(path, 'califData.pickle')
-        print(f'\nSaving data to {filename} ...')
-        output = {'saveDateTime': datetime.datetime.now(), 'data': self.data}
-        with open(filename, 'wb') as f:
-            pickle.dump(output, f)
-
+        # Only releases parsed since the last save are written
+        store = self.openStore(path)
+        print(f'\nSaving {len(self.unsaved)} new or changed releases to {store.filename} ...')
+        store.putRecords({url: self.data[url] for url in self.unsaved}, {url: self.pages[url] for url in self.unsaved if url in self.pages})
+        self.unsaved.clear()
+        self.pages.clear()
+
+    @instrument()
     def loadData(self, path):
+        filename = os.path.join(path, 'califData.sqlite')
+        if os.path.exists(filename):
+            print(f'\nLoading data from {filename} ...')
+            self.setData(self.openStore(path).getRecords())
+        else:
+            self.loadPickle(path)
+
+    def loadPickle(self, path):
+        # Data saved before the SQLite store. The records are marked unsaved so that the
+        # next saveData moves them, and their raw pages, into the store.
         filename = os.path.join(path, 'califData.pickle')
         if os.path.exists(filename):
             print(f'\nLoading data from {filename} ...')
-            f = open(filename, 'rb')
-            data = pickle.load(f)
-            self.data = data['data']
+            with open(filename, 'rb') as f:
+                data = pickle.load(f)
+            for url, record in data['data'].items():
+                response = record.pop('webResponse', None)
+                if response is not None:
+                    self.pages[url] = response.content
+            self.setData(data['data'])
+            self.unsaved = set(self.data)
         else:
             print('No data file!')
 
-    def writeCsv(self, path):
-        data = self.dataToNumpy()
+    def loadCsv(self, path):
+        # The checked-in snapshot, for use without the store (no pages, keyed by release number)
         filename = os.path.join(path, 'califData.csv')
-        print(f'\nExporting data to {filename} ...')
-        with open(filename, 'wt') as f:
-            f.write('date,releaseNumber,cases,deaths,testsConducted,testsReceived,testsPending\n')
-            dateUrlList = sorted([(self.data[url]['releaseDate'], url) for url in self.data.keys()])
-            for releaseDate, url, in dateUrlList:
-                record = self.data[url]
-                output = []
-                output.append(record['releaseDate'].strftime('%Y-%m-%d'))
-                output.append(record['releaseNumber'])
-                for field in ['cases', 'deaths', 'testsConducted', 'testsReceived', 'testsPending']:
-                    if record[field] is not None:
-                        output.append(str(record[field]))
-                    else:
-                        output.append('')
-                f.write(','.join(output) + '\n')
+        print(f'\nLoading data from {filename} ...')
+        data = dict(self.data)
+        with open(filename, 'rt', newline='') as f:
+            for row in csv.DictReader(f):
+                record = {'releaseDate': datetime.datetime.strptime(row['date'], '%Y-%m-%d'), 'releaseNumber': row['releaseNumber']}
+                for field in countFields:
+                    record[field] = int(row[field]) if row[field] else None
+                data[row['releaseNumber']] = record
+        self.setData(data)
+
+    def writeCsv(self, path, append=False):
+        # With append, only releases after the rows already in the file are written. If the
+        # file does not match the start of the current data (e.g. after a reparse changed an
+        # earlier release) it is rewritten.
+        filename = os.path.join(path, 'califData.csv')
+        lines = [csvLine(self.data[url]) for releaseDate, url in self.index]
+        written = 0
+        if append and os.path.exists(filename):
+            with open(filename, 'rt') as f:
+                existing = f.read().splitlines()
+            if existing[:1] == [csvHeader] and existing[1:] == lines[:len(existing)-1]:
+                written = len(existing) - 1
+        if written:
+            print(f'\nAppending {len(lines) - written} rows to {filename} ...')
+            with open(filename, 'at') as f:
+                f.writelines(line + '\n' for line in lines[written:])
+        else:
+            print(f'\nExporting data to {filename} ...')
+            with open(filename, 'wt') as f:
+                f.writelines(line + '\n' for line in [csvHeader] + lines)
 
     def getNewestRecord(self):
-        dateUrlList = sorted([(self.data[url]['releaseDate'], url) for url in self.data.keys()])
-        return self.data[dateUrlList[-1][1]]
+        return self.data[self.index[-1][1]]
 
     def printRecord(self, record):
         output = f"Date: {record['releaseDate'].strftime('%Y-%m-%d')} ({record['releaseNumber']}) - "
@@ -195,32 +266,55 @@ class CdphCovidData(object):
         output += f"Tests: {record['testsConducted']} (Received: {record['testsReceived']} / Pending: {record['testsPending']})"
         print(output)
 
+    @instrument(countRows=True)
     def dataToNumpy(self):
-        dateUrlList = sorted([(self.data[url]['releaseDate'], url) for url in self.data.keys()])
-        output = np.zeros(len(dateUrlList), dtype=[('date', 'datetime64[us]'), ('cases', 'f8'), ('deaths', 'f8'), ('testsConducted', 'f8'), ('testsReceived', 'f8'), ('testsPending', 'f8')])
-        for i, (releaseDate, url) in enumerate(dateUrlList):
-            record = self.data[url]
-            output[i]['date'] = releaseDate
-            output[i]['cases'] = record['cases'] if record['cases'] is not None else float('nan')
-            output[i]['deaths'] = record['deaths'] if record['cases'] is not None else float('nan')
-            output[i]['testsConducted'] = record['testsConducted'] if record['cases'] is not None else float('nan')
-            output[i]['testsReceived'] = record['testsReceived'] if record['cases'] is not None else float('nan')
-            output[i]['testsPending'] = record['testsPending'] if record['cases'] is not None else float('nan')
-
-        return output
+        # A copy of the cached array, so callers are free to modify it
+        if self.array is None:
+            records = [self.data[url] for releaseDate, url in self.index]
+            self.array = np.zeros(len(records), dtype=cdphDtype)
+            self.array['date'] = np.array([record['releaseDate'] for record in records], dtype='datetime64[us]')
+            for field in countFields:
+                self.array[field] = np.array([np.nan if record[field] is None else record[field] for record in records], dtype=float)
+        return self.array.copy()
 
 
 if __name__=='__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--dataPath', default='./data')
+    parser.add_argument('--baseUrl', default='https://www.cdph.ca.gov', help='CDPH website (e.g. a local mirror)')
     parser.add_argument('--force', action='store_true', help='Force reload of all data')
+    parser.add_argument('--reparse', action='store_true', help='Re-parse the archived release pages instead of querying the website')
+    parser.add_argument('--processes', type=int, default=None, help='Number of processes for --reparse (default: all cores)')
+    parser.add_argument('--maxWorkers', type=int, default=4, help='Number of news releases fetched concurrently')
+    parser.add_argument('--requestsPerSecond', type=float, default=4, help='Request rate limit for the CDPH website')
+    parser.add_argument('--httpCachePath', default=None, help='Directory for cached web pages (default: <dataPath>/httpCache)')
+    parser.add_argument('--httpCacheSize', type=float, default=200, help='Maximum size of the web page cache in MB')
+    parser.add_argument('--noHttpCache', action='store_true', help='Download every page instead of using cached copies')
+    parser.add_argument('--htmlBackend', default=None, help='BeautifulSoup parser for the releases (default: lxml if installed, else html.parser)')
+    parser.add_argument('--report', default=None, help='Write a JSON report of the time and memory used by each stage to this file')
+    parser.add_argument('--profile', default=None, help='Directory for a cProfile dump of each top-level stage')
     args = parser.parse_args()
-
-    cdphData = CdphCovidData()
-    cdphData.loadData(args.dataPath)
-    print(f'\nQuerying CDPH website: {cdphData.newsReleaseUrl}')
-    cdphData.getData(force=args.force)
-    cdphData.saveData(args.dataPath)
-    cdphData.writeCsv(args.dataPath)
+    if args.report or args.profile:
+        configure(args.profile)
+
+    cache = None
+    if not args.noHttpCache:
+        cachePath = args.httpCachePath or os.path.join(args.dataPath, 'httpCache')
+        cache = ResponseCache(cachePath, maxBytes=int(args.httpCacheSize*1024*1024))
+    fetcher = Fetcher(maxWorkers=args.maxWorkers, requestsPerSecond=args.requestsPerSecond, cache=cache)
+    cdphData = CdphCovidData(args.baseUrl, fetcher=fetcher, backend=args.htmlBackend)
+    try:
+        cdphData.loadData(args.dataPath)
+        if args.reparse:
+            cdphData.reparse(args.dataPath, processes=args.processes)
+        else:
+            print(f'\nQuerying CDPH website: {cdphData.newsReleaseUrl}')
+            cdphData.getData(force=args.force)
+        cdphData.saveData(args.dataPath)
+        cdphData.writeCsv(args.dataPath, append=True)
+    finally:
+        fetcher.close()
+    if args.report:
+        writeReport(args.report)
     
\ No newline at end of file
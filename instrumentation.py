@@ -0,0 +1,143 @@
+import os
+import sys
+import json
+import time
+import resource
+import cProfile
+import functools
+import collections
+
+
+# Spans are only recorded once configure() has been called, so instrumented code costs
+# nothing extra in long-running processes (e.g. queryServer.py) that never report.
+enabled = False
+profilePath = None
+records = []
+stack = []
+profileCounts = collections.Counter()
+
+def configure(profile=None):
+    # profile: directory for a cProfile dump of every top-level span
+    global enabled, profilePath
+    enabled = True
+    profilePath = profile
+    if profile:
+        os.makedirs(profile, exist_ok=True)
+
+def memoryStatus(field):
+    # VmHWM (peak) or VmRSS (current) of this process in MB. On Linux VmHWM is the
+    # process's own peak, while ru_maxrss would include the peak of the parent that
+    # started it; ru_maxrss is in bytes on macOS.
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status', 'rt') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def peakRssMB():
+    return memoryStatus('VmHWM')
+
+
+class Span(object):
+    # Times a block of code: wall and CPU time, the process's peak RSS when it ends and
+    # how much the span raised that peak, plus any counts the code adds (rows, bytes)
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+        self.counts = {}
+        self.profiler = None
+
+    def add(self, **counts):
+        for name, value in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def __enter__(self):
+        if not enabled:
+            return self
+        self.parent = stack[-1].name if stack else None
+        self.depth = len(stack)
+        stack.append(self)
+        if profilePath and self.depth == 0:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.startPeak = peakRssMB()
+        self.wallStart = time.perf_counter()
+        self.cpuStart = time.process_time()
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        if not enabled or not stack or stack[-1] is not self:
+            return False
+        wall = time.perf_counter() - self.wallStart
+        cpu = time.process_time() - self.cpuStart
+        peak = peakRssMB()
+        stack.pop()
+        record = {'name': self.name, 'parent': self.parent, 'depth': self.depth, 'pid': os.getpid(), 'start': self.wallStart,
+                  'wall': wall, 'cpu': cpu, 'peakRssMB': peak, 'peakGrowthMB': peak - self.startPeak}
+        record.update(self.fields)
+        record.update(self.counts)
+        if exceptionType is not None:
+            record['error'] = exceptionType.__name__
+        if self.profiler is not None:
+            self.profiler.disable()
+            profileCounts[self.name] += 1
+            record['profile'] = os.path.join(profilePath, f'{self.name}-{os.getpid()}-{profileCounts[self.name]}.prof')
+            self.profiler.dump_stats(record['profile'])
+        records.append(record)
+        return False
+
+def span(name, **fields):
+    return Span(name, **fields)
+
+def currentSpan():
+    # The innermost open span, for adding counts; a detached one if there is none
+    return stack[-1] if enabled and stack else Span(None)
+
+def instrument(name=None, countRows=False):
+    # Decorator: run each call of the function in a span named after it. With countRows,
+    # the length of the returned value is added as rows.
+    def decorator(function):
+        spanName = name or function.__qualname__
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with Span(spanName) as span:
+                result = function(*args, **kwargs)
+                if countRows:
+                    span.add(rows=len(result))
+                return result
+        return wrapper
+    return decorator
+
+def takeRecords():
+    # Spans recorded so far in this process (e.g. a pool worker), removed from it
+    taken = records[:]
+    del records[:]
+    return taken
+
+def addRecords(spans):
+    if enabled:
+        records.extend(spans)
+
+def report():
+    totals = {}
+    for record in records:
+        total = totals.setdefault(record['name'], {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peakRssMB': 0.0})
+        total['calls'] += 1
+        total['wall'] += record['wall']
+        total['cpu'] += record['cpu']
+        total['peakRssMB'] = max(total['peakRssMB'], record['peakRssMB'])
+        for field in ['rows', 'bytes']:
+            if field in record:
+                total[field] = total.get(field, 0) + record[field]
+    return {'argv': sys.argv, 'pid': os.getpid(), 'peakRssMB': peakRssMB(), 'totals': totals, 'spans': records}
+
+def writeReport(filename):
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'wt') as f:
+        json.dump(report(), f, indent=1)
+    print(f'\nRun report written to {filename}')
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import csv
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from csvCache import encodedDtype, encodeColumn, replaceFile, defaultCachePath, buildRegionIndex, decodeRows, sumByDate
+
+
+jhuDtype = [('date', 'datetime64[us]'), ('country', 'U64'), ('state', 'U64'), ('county', 'U64'), ('fips', 'u4'), ('cases', 'i4'), ('deaths', 'i4'), ('recovered', 'i4')]
+
+# Column names across the daily report schemas (renamed on 2020-03-22, Admin2/FIPS added)
+columnNames = {
+    'Country/Region': 'country', 'Country_Region': 'country',
+    'Province/State': 'state', 'Province_State': 'state',
+    'Admin2': 'county', 'FIPS': 'fips',
+    'Confirmed': 'cases', 'Deaths': 'deaths', 'Recovered': 'recovered',
+}
+
+countryNames = {
+    'Mainland China': 'China', 'Hong Kong SAR': 'Hong Kong', 'Macao SAR': 'Macau',
+    'South Korea': 'Korea, South', 'Republic of Korea': 'Korea, South',
+    'Iran (Islamic Republic of)': 'Iran', 'UK': 'United Kingdom', 'Czech Republic': 'Czechia',
+    'Russian Federation': 'Russia', 'Viet Nam': 'Vietnam', 'Taiwan': 'Taiwan*',
+}
+
+usStates = {
+    'AL': 'Alabama', 'AK': 'Alaska', 'AZ': 'Arizona', 'AR': 'Arkansas', 'CA': 'California', 'CO': 'Colorado',
+    'CT': 'Connecticut', 'DE': 'Delaware', 'DC': 'District of Columbia', 'D.C.': 'District of Columbia',
+    'FL': 'Florida', 'GA': 'Georgia', 'HI': 'Hawaii', 'ID': 'Idaho', 'IL': 'Illinois', 'IN': 'Indiana',
+    'IA': 'Iowa', 'KS': 'Kansas', 'KY': 'Kentucky', 'LA': 'Louisiana', 'ME': 'Maine', 'MD': 'Maryland',
+    'MA': 'Massachusetts', 'MI': 'Michigan', 'MN': 'Minnesota', 'MS': 'Mississippi', 'MO': 'Missouri',
+    'MT': 'Montana', 'NE': 'Nebraska', 'NV': 'Nevada', 'NH': 'New Hampshire', 'NJ': 'New Jersey',
+    'NM': 'New Mexico', 'NY': 'New York', 'NC': 'North Carolina', 'ND': 'North Dakota', 'OH': 'Ohio',
+    'OK': 'Oklahoma', 'OR': 'Oregon', 'PA': 'Pennsylvania', 'RI': 'Rhode Island', 'SC': 'South Carolina',
+    'SD': 'South Dakota', 'TN': 'Tennessee', 'TX': 'Texas', 'UT': 'Utah', 'VT': 'Vermont', 'VA': 'Virginia',
+    'WA': 'Washington', 'WV': 'West Virginia', 'WI': 'Wisconsin', 'WY': 'Wyoming', 'PR': 'Puerto Rico',
+}
+
+reportPattern = re.compile(r'^(\d\d)-(\d\d)-(\d\d\d\d)\.csv$')
+
+def reportDate(filename):
+    month, day, year = reportPattern.match(os.path.basename(filename)).groups()
+    return np.datetime64(f'{year}-{month}-{day}')
+
+def splitUsLocation(location):
+    # Before 2020-03-22 some US rows name a county or city: 'King County, WA', 'Chicago, IL'
+    place, _, abbreviation = location.rpartition(', ')
+    if place and abbreviation.strip() in usStates:
+        return usStates[abbreviation.strip()], re.sub(r' County$', '', place.strip())
+    return location, ''
+
+def toNumber(text):
+    # Counts are sometimes blank or written as floats ('6037.0')
+    text = text.strip()
+    return int(float(text)) if text else 0
+
+def parseDailyReport(filename):
+    # One daily report, normalized to jhuDtype with names still as text
+    date = reportDate(filename)
+    rows = []
+    with open(filename, 'rt', encoding='utf-8-sig', newline='') as f:
+        reader = csv.reader(f)
+        header = [columnNames.get(name.strip()) for name in next(reader)]
+        for row in reader:
+            if not row:
+                continue
+            record = dict(zip(header, row))
+            country = record.get('country', '').strip()
+            country = countryNames.get(country, country)
+            state = record.get('state', '').strip()
+            county = record.get('county', '').strip()
+            if country == 'US' and not county:
+                state, county = splitUsLocation(state)
+            rows.append((date, country, state, county, toNumber(record.get('fips', '')),
+                         toNumber(record.get('cases', '')), toNumber(record.get('deaths', '')), toNumber(record.get('recovered', ''))))
+    return np.array(rows, dtype=jhuDtype)
+
+
+class JhuData(object):
+    # The JHU CSSE daily reports with the NytData query surface. Each daily file is
+    # parsed once; the encoded rows are cached with the size and mtime of the files they
+    # came from, so a refresh only parses new or changed files.
+    def __init__(self, path, cachePath=None, useCache=True, processes=None):
+        self.path = path
+        self.reportsPath = os.path.join(path, 'csse_covid_19_data', 'csse_covid_19_daily_reports')
+        self.cachePath = cachePath if cachePath is not None else defaultCachePath(path)
+        self.useCache = useCache
+        self.processes = processes
+
+    def reportFiles(self):
+        return sorted([name for name in os.listdir(self.reportsPath) if reportPattern.match(name)], key=reportDate)
+
+    def cacheFilenames(self):
+        base = os.path.join(self.cachePath, 'jhuDailyReports')
+        return base + '.npy', base + '.names.npz', base + '.files.json'
+
+    def loadSource(self):
+        files = {}
+        for name in self.reportFiles():
+            stat = os.stat(os.path.join(self.reportsPath, name))
+            files[name] = {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+        data, tables, cachedFiles = None, {}, {}
+        cacheFilename, tablesFilename, filesFilename = self.cacheFilenames()
+        if self.useCache and all(os.path.exists(f) for f in self.cacheFilenames()):
+            with open(filesFilename, 'rt') as f:
+                cachedFiles = json.load(f)
+            with np.load(tablesFilename) as cachedTables:
+                tables = dict(cachedTables)
+            data = np.load(cacheFilename, mmap_mode='r')
+
+        unchanged = [name for name in files if cachedFiles.get(name) == files[name]]
+        parse = [name for name in files if name not in unchanged]
+        if parse or len(unchanged) != len(cachedFiles):
+            print(f'Parsing {len(parse)} of {len(files)} daily reports in {self.reportsPath} ...')
+            kept = []
+            if data is not None and unchanged:
+                kept.append(np.asarray(data[np.isin(data['date'], [reportDate(name) for name in unchanged])]))
+            parsed = self.parseReports(parse)
+            if len(parsed):
+                encoded = np.zeros(len(parsed), dtype=encodedDtype(jhuDtype))
+                for name, fieldType in jhuDtype:
+                    if fieldType.startswith('U'):
+                        tables[name], encoded[name] = encodeColumn(parsed[name], tables.get(name))
+                    else:
+                        encoded[name] = parsed[name]
+                kept.append(encoded)
+            data = np.concatenate(kept) if kept else np.zeros(0, dtype=encodedDtype(jhuDtype))
+            data = data[np.argsort(data['date'], kind='stable')]
+            for name, fieldType in jhuDtype:
+                if fieldType.startswith('U') and name not in tables:
+                    tables[name] = np.zeros(0, dtype=fieldType)
+            if self.useCache:
+                try:
+                    replaceFile(cacheFilename, lambda f: np.save(f, data))
+                    replaceFile(tablesFilename, lambda f: np.savez(f, **tables))
+                    replaceFile(filesFilename, lambda f: f.write(json.dumps(files, indent=1).encode('utf-8')))
+                except OSError as e:
+                    print(f'WARNING - failed to write cache {cacheFilename}: {e}')
+        else:
+            print(f'Loading cached data from {cacheFilename} ...')
+        self.data, self.tables = data, tables
+        self.index()
+
+    def parseReports(self, names):
+        filenames = [os.path.join(self.reportsPath, name) for name in names]
+        processes = self.processes or os.cpu_count()
+        if len(filenames) < 2 or processes <= 1:
+            reports = [parseDailyReport(filename) for filename in filenames]
+        else:
+            with ProcessPoolExecutor(processes) as executor:
+                reports = list(executor.map(parseDailyReport, filenames, chunksize=max(1, len(filenames) // (processes * 4))))
+        return np.concatenate(reports) if reports else np.zeros(0, dtype=jhuDtype)
+
+    def index(self):
+        self.dates, self.dateIdx = np.unique(self.data['date'], return_inverse=True)
+        self.codes = {name: {value: code for code, value in enumerate(table)} for name, table in self.tables.items()}
+        numStates, numCounties = len(self.tables['state']), len(self.tables['county'])
+        stateKeys = self.data['country'].astype('i8') * numStates + self.data['state']
+        self.statesOrder, self.statesIndex = buildRegionIndex(stateKeys)
+        self.countiesOrder, self.countiesIndex = buildRegionIndex(stateKeys * numCounties + self.data['county'])
+
+    def stateRows(self, name, country='US'):
+        # Row numbers of a state, in date order
+        if country not in self.codes['country'] or name not in self.codes['state']:
+            return np.zeros(0, dtype=np.intp)
+        key = self.codes['country'][country] * len(self.tables['state']) + self.codes['state'][name]
+        start, stop = self.statesIndex.get(key, (0, 0))
+        return self.statesOrder[start:stop]
+
+    def countyRows(self, county, state, country='US'):
+        if country not in self.codes['country'] or state not in self.codes['state'] or county not in self.codes['county']:
+            return np.zeros(0, dtype=np.intp)
+        key = (self.codes['country'][country] * len(self.tables['state']) + self.codes['state'][state]) * len(self.tables['county']) + self.codes['county'][county]
+        start, stop = self.countiesIndex.get(key, (0, 0))
+        return self.countiesOrder[start:stop]
+
+    def countryRows(self, name):
+        if name not in self.codes['country']:
+            return np.zeros(0, dtype=np.intp)
+        return np.flatnonzero(self.data['country'] == self.codes['country'][name])
+
+    def regionSeries(self, idx, startDate=None):
+        # Cases and deaths of the selected rows summed per date, over the dates they report
+        output = sumByDate(self.data, self.dates, self.dateIdx, idx)
+        output = output[np.bincount(self.dateIdx[idx], minlength=len(self.dates)) > 0]
+        if startDate:
+            output = output[output['date'] >= startDate]
+        return output
+
+    def getState(self, name, startDate=None, country='US'):
+        # Early reports list some US counties and cities instead of the state, so the state
+        # series is always the sum of its rows
+        return self.regionSeries(self.stateRows(name, country), startDate)
+
+    def getCounty(self, county, state, startDate=None):
+        data = self.data[self.countyRows(county, state)]
+        if startDate:
+            data = data[data['date'] >= np.datetime64(startDate)]
+        return decodeRows(data, self.tables, jhuDtype)
+
+    def getCountry(self, name, startDate=None):
+        return self.regionSeries(self.countryRows(name), startDate)
+
+    def getStatesSum(self, states=None, startDate=None, country='US'):
+        if states:
+            idx = np.concatenate([self.stateRows(state, country) for state in states])
+        else:
+            idx = self.countryRows(country)
+        return sumByDate(self.data, self.dates, self.dateIdx, idx, startDate)
+
+    def getCountiesSum(self, counties, state, startDate=None):
+        return self.getRegionsSum(regions=[(state, county) for county in counties], startDate=startDate)
+
+    def getRegionsSum(self, regions=None, fips=None, startDate=None):
+        # Sum any set of US counties, given as (state, county) pairs and/or FIPS codes
+        idx = [np.zeros(0, dtype=np.intp)]
+        if regions:
+            idx += [self.countyRows(county, state) for state, county in regions]
+        if fips is not None and len(fips):
+            idx.append(np.flatnonzero(np.isin(self.data['fips'], fips)))
+        idx = np.unique(np.concatenate(idx))
+        return sumByDate(self.data, self.dates, self.dateIdx, idx, startDate)
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Load the JHU CSSE daily reports and print a region')
+    parser.add_argument('--dataPath', default='./data')
+    parser.add_argument('--cachePath', default=None, help='Directory for the binary data cache (default: <dataPath>/cache/jhu_csse)')
+    parser.add_argument('--noCache', action='store_true')
+    parser.add_argument('--processes', type=int, default=None, help='Number of processes parsing daily reports (default: all cores)')
+    parser.add_argument('--country', default='US')
+    parser.add_argument('--state', default=None)
+    parser.add_argument('--county', default=None)
+    parser.add_argument('--days', type=int, default=7, help='Number of most recent days to print')
+    args = parser.parse_args()
+    if args.county and not args.state:
+        parser.error('--county requires --state')
+
+    jhuData = JhuData(os.path.join(args.dataPath, 'jhu_csse'), cachePath=args.cachePath, useCache=not args.noCache, processes=args.processes)
+    jhuData.loadSource()
+    if args.county:
+        data = jhuData.getCounty(args.county, args.state)
+    elif args.state:
+        data = jhuData.getState(args.state, country=args.country)
+    else:
+        data = jhuData.getCountry(args.country)
+    for row in data[-args.days:]:
+        print(f"{str(row['date'].astype('datetime64[D]'))}: {row['cases']} cases, {row['deaths']} deaths")
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+import os
+
+import numpy as np
+
+from csvCache import loadCachedCsv, readChunks, replaceFile, defaultCachePath, buildRegionIndex, decodeRows, sumByDate
+from instrumentation import instrument, currentSpan
+
+
+countiesDtype = [('date', 'datetime64[us]'), ('county', 'U64'), ('state', 'U64'), ('fips', 'u4'), ('cases', 'i4'), ('deaths', 'i4')]
+statesDtype = [('date', 'datetime64[us]'), ('state', 'U64'), ('fips', 'u4'), ('cases', 'i4'), ('deaths', 'i4')]
+
+def streamSumsByDate(chunks, selectors, startDate=None):
+    # One pass over a stream of decoded chunks, summing cases and deaths per date for each
+    # selector (a function of a chunk returning a row mask). Only the per-date totals are
+    # kept, so memory is bounded by the chunk size and the number of dates. Each output
+    # covers every date in the stream, as in sumByDate.
+    firstDay, seen = None, np.zeros(0, dtype=bool)
+    totals = np.zeros((len(selectors), 2, 0))
+    for chunk in chunks:
+        days = chunk['date'].astype('datetime64[D]').astype('i8')
+        if firstDay is None:
+            firstDay = days.min()
+        start, stop = min(firstDay, days.min()), max(firstDay + len(seen), days.max() + 1)
+        if start < firstDay or stop > firstDay + len(seen):
+            seen = np.concatenate([np.zeros(firstDay - start, dtype=bool), seen, np.zeros(stop - firstDay - len(seen), dtype=bool)])
+            totals = np.concatenate([np.zeros(totals.shape[:2] + (firstDay - start,)), totals, np.zeros(totals.shape[:2] + (stop - firstDay - totals.shape[2],))], axis=2)
+            firstDay = start
+        dayIdx = days - firstDay
+        seen[dayIdx] = True
+        for i, select in enumerate(selectors):
+            mask = select(chunk)
+            for j, field in enumerate(['cases', 'deaths']):
+                totals[i, j] += np.bincount(dayIdx[mask], weights=chunk[field][mask], minlength=len(seen))
+
+    dates = (np.flatnonzero(seen) + (firstDay or 0)).astype('datetime64[D]')
+    outputs = []
+    for i in range(len(selectors)):
+        output = np.zeros(len(dates), dtype=[('date', 'datetime64[us]'), ('cases', 'i4'), ('deaths', 'i4')])
+        output['date'] = dates
+        output['cases'] = totals[i, 0, seen]
+        output['deaths'] = totals[i, 1, seen]
+        if startDate:
+            output = output[output['date'] >= startDate]
+        outputs.append(output)
+    return outputs
+
+def regionSelector(states=None, regions=None, fips=None):
+    # Row mask of a chunk: any of the states, (state, county) pairs or FIPS codes, or
+    # every row if none are given
+    def select(chunk):
+        if states is None and regions is None and fips is None:
+            return np.ones(len(chunk), dtype=bool)
+        mask = np.zeros(len(chunk), dtype=bool)
+        if states:
+            mask |= np.isin(chunk['state'], states)
+        for state, county in regions or []:
+            mask |= (chunk['state'] == state) & (chunk['county'] == county)
+        if fips is not None and len(fips):
+            mask |= np.isin(chunk['fips'], fips)
+        return mask
+    return select
+
+def joinRows(rows, dtype, startDate=None):
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=dtype)
+    if startDate and len(rows):
+        rows = rows[rows['date'] >= np.datetime64(startDate)]
+    return rows
+
+def streamRows(chunks, select, dtype, startDate=None):
+    # The selected rows of a stream of chunks
+    return joinRows([chunk[select(chunk)] for chunk in chunks], dtype, startDate)
+
+def streamQueries(chunks, rowSelectors, sumSelectors, dtype, startDate=None):
+    # The rows of each row selector (as streamRows) and the per-date sums of each sum
+    # selector (as streamSumsByDate), in a single pass over the chunks
+    rows = [[] for select in rowSelectors]
+    def collect():
+        for chunk in chunks:
+            for i, select in enumerate(rowSelectors):
+                rows[i].append(chunk[select(chunk)])
+            yield chunk
+    sums = streamSumsByDate(collect(), sumSelectors, startDate)
+    return [joinRows(selected, dtype, startDate) for selected in rows], sums
+
+def forwardFill(values):
+    # Carry the last reported value forward along each row (in place). Nothing has been
+    # reported before a region's first row, so its cumulative counts start at zero.
+    valid = ~np.isnan(values)
+    idx = np.where(valid, np.arange(values.shape[1]), 0)
+    np.maximum.accumulate(idx, axis=1, out=idx)
+    filled = np.take_along_axis(values, idx, axis=1)
+    filled[~np.logical_or.accumulate(valid, axis=1)] = 0
+    values[:] = filled
+
+def buildCube(data, keys, dateIdx, numDates, fill='ffill', filename=None):
+    # Scatter cases and deaths into a dense (field, region, date) array, one region per
+    # unique key. Days a region does not report are NaN unless forward filled.
+    regionKeys = np.unique(keys)
+    rowRegion = np.searchsorted(regionKeys, keys)
+    values = np.full((2, len(regionKeys), numDates), np.nan)
+    for i, field in enumerate(['cases', 'deaths']):
+        values[i, rowRegion, dateIdx] = data[field]
+        if fill == 'ffill':
+            forwardFill(values[i])
+    if filename:
+        try:
+            replaceFile(filename, lambda f: np.save(f, values))
+        except OSError as e:
+            print(f'WARNING - failed to write cache {filename}: {e}')
+    return regionKeys, rowRegion, values
+
+def newCases(data):
+    return np.diff(data['cases'])
+
+def dailyDeaths(data):
+    return np.diff(data['deaths'])
+
+class RegionCube(object):
+    # Dense region x date view of the NYT data. cases and deaths are 2-D arrays with one
+    # row per region (labelled in self.labels) and one column per date, so the series
+    # kernels in timeSeries.py run over every region at once.
+    def __init__(self, dates, labels, cases, deaths):
+        self.dates = dates
+        self.labels = labels
+        self.cases = cases
+        self.deaths = deaths
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, field):
+        if field == 'date':
+            return self.dates
+        if field in ['cases', 'deaths']:
+            return getattr(self, field)
+        return self.labels[field]
+
+    def find(self, state, county=None):
+        idx = self.labels['state'] == state
+        if county is not None:
+            idx &= self.labels['county'] == county
+        rows = np.flatnonzero(idx)
+        return int(rows[0]) if len(rows) else None
+
+    def select(self, rows=None, startDate=None):
+        rows = slice(None) if rows is None else rows
+        start = np.searchsorted(self.dates, np.datetime64(startDate)) if startDate else 0
+        return RegionCube(self.dates[start:], self.labels[rows], self.cases[rows, start:], self.deaths[rows, start:])
+
+    def sum(self, rows=None, startDate=None):
+        cube = self.select(rows, startDate)
+        output = np.zeros(len(cube.dates), dtype=[('date', 'datetime64[us]'), ('cases', 'f8'), ('deaths', 'f8')])
+        output['date'] = cube.dates
+        output['cases'] = np.nansum(cube.cases, axis=0)
+        output['deaths'] = np.nansum(cube.deaths, axis=0)
+        return output
+
+class NytData(object):
+    # With streaming, nothing is loaded up front: every query streams the CSV in chunks of
+    # chunkRows rows and keeps only its result. The cube and row lookups need the loaded
+    # tables and are not available.
+    def __init__(self, path, cachePath=None, useCache=True, incremental=True, streaming=False, chunkRows=20000):
+        self.path = path
+        self.cachePath = cachePath if cachePath is not None else defaultCachePath(path)
+        self.useCache = useCache
+        self.incremental = incremental
+        self.streaming = streaming
+        self.chunkRows = chunkRows
+        self.countiesFilename = os.path.join(path, 'us-counties.csv')
+        self.statesFilename = os.path.join(path, 'us-states.csv')
+        self.filenames = [self.countiesFilename, self.statesFilename]
+        # Bumped on every load, so derived data can tell when it is stale
+        self.revision = 0
+
+    def loadSource(self):
+        if self.streaming:
+            return
+        self.loadCounties()
+        self.loadStates()
+
+    def getCube(self, level='counties', fill='ffill'):
+        # Dense region x date arrays for 'counties' or 'states'; fill is 'ffill' or None (NaN).
+        # Memory mapped from the cache directory when the cache is enabled.
+        if level == 'counties':
+            data, tables, dates, dateIdx = self.countiesData, self.countiesTables, self.countiesDates, self.countiesDateIdx
+            keys = self.countiesData['state'].astype('i8') * len(tables['county']) + self.countiesData['county']
+            sourceFilename = self.countiesFilename
+        elif level == 'states':
+            data, tables, dates, dateIdx = self.statesData, self.statesTables, self.statesDates, self.statesDateIdx
+            keys = self.statesData['state'].astype('i8')
+            sourceFilename = self.statesFilename
+        else:
+            raise ValueError(f'Unknown cube level: {level}')
+
+        filename = self.cacheFilename(sourceFilename)
+        if filename:
+            filename = os.path.splitext(filename)[0] + f'.cube-{fill or "nan"}.npy'
+        if filename and os.path.exists(filename) and os.path.getmtime(filename) >= self.modificationTime():
+            regionKeys = np.unique(keys)
+            rowRegion = np.searchsorted(regionKeys, keys)
+            values = np.load(filename, mmap_mode='r')
+        else:
+            regionKeys, rowRegion, values = buildCube(data, keys, dateIdx, len(dates), fill, filename)
+
+        labelsDtype = [(name, fieldType) for name, fieldType in (countiesDtype if level == 'counties' else statesDtype) if name in tables or name == 'fips']
+        labels = np.zeros(len(regionKeys), dtype=labelsDtype)
+        if level == 'counties':
+            labels['state'] = tables['state'][regionKeys // len(tables['county'])]
+            labels['county'] = tables['county'][regionKeys % len(tables['county'])]
+        else:
+            labels['state'] = tables['state'][regionKeys]
+        labels['fips'][rowRegion] = data['fips']
+        return RegionCube(dates, labels, values[0], values[1])
+
+    @instrument()
+    def loadCounties(self):
+        self.countiesData, self.countiesTables = loadCachedCsv(self.countiesFilename, countiesDtype, self.cacheFilename(self.countiesFilename), self.modificationTime(), self.incremental)
+        currentSpan().add(rows=len(self.countiesData))
+        self.indexCounties()
+        self.revision += 1
+
+    @instrument()
+    def loadStates(self):
+        self.statesData, self.statesTables = loadCachedCsv(self.statesFilename, statesDtype, self.cacheFilename(self.statesFilename), self.modificationTime(), self.incremental)
+        currentSpan().add(rows=len(self.statesData))
+        self.indexStates()
+        self.revision += 1
+
+    def indexCounties(self):
+        self.countiesDates, self.countiesDateIdx = np.unique(self.countiesData['date'], return_inverse=True)
+        self.countiesStateCodes = {name: code for code, name in enumerate(self.countiesTables['state'])}
+        self.countiesCountyCodes = {name: code for code, name in enumerate(self.countiesTables['county'])}
+        keys = self.countiesData['state'].astype('i8') * len(self.countiesTables['county']) + self.countiesData['county']
+        self.countiesOrder, self.countiesIndex = buildRegionIndex(keys)
+
+    def indexStates(self):
+        self.statesDates, self.statesDateIdx = np.unique(self.statesData['date'], return_inverse=True)
+        self.statesCodes = {name: code for code, name in enumerate(self.statesTables['state'])}
+        self.statesOrder, self.statesIndex = buildRegionIndex(self.statesData['state'])
+
+    def cacheFilename(self, filename):
+        if not self.useCache:
+            return None
+        basename = os.path.splitext(os.path.basename(filename))[0]
+        return os.path.join(self.cachePath, basename + '.npy')
+
+    def modificationTime(self):
+        return max([os.path.getmtime(path) for path in self.filenames])
+
+    def stateRows(self, name):
+        # Row numbers of a state in statesData, in date order
+        if name not in self.statesCodes:
+            return np.zeros(0, dtype=np.intp)
+        start, stop = self.statesIndex.get(self.statesCodes[name], (0, 0))
+        return self.statesOrder[start:stop]
+
+    def countyRows(self, county, state):
+        # Row numbers of a county in countiesData, in date order
+        if state not in self.countiesStateCodes or county not in self.countiesCountyCodes:
+            return np.zeros(0, dtype=np.intp)
+        key = self.countiesStateCodes[state] * len(self.countiesTables['county']) + self.countiesCountyCodes[county]
+        start, stop = self.countiesIndex.get(key, (0, 0))
+        return self.countiesOrder[start:stop]
+
+    def countiesChunks(self):
+        return readChunks(self.countiesFilename, countiesDtype, self.chunkRows)
+
+    def statesChunks(self):
+        return readChunks(self.statesFilename, statesDtype, self.chunkRows)
+
+    def queryStates(self, names, groups, startDate=None):
+        # getState of each name and getStatesSum of each group, {key: [state, ...] or None
+        # for all states}, in one pass over the states CSV when streaming
+        if not self.streaming:
+            return ({name: self.getState(name, startDate) for name in names},
+                    {key: self.getStatesSum(states, startDate) for key, states in groups.items()})
+        rows, sums = streamQueries(self.statesChunks(), [regionSelector(states=[name]) for name in names],
+                                   [regionSelector(states=states or None) for states in groups.values()], statesDtype, startDate)
+        return dict(zip(names, rows)), dict(zip(groups, sums))
+
+    def queryCounties(self, regions, groups, startDate=None):
+        # getCounty of each (state, county) and getRegionsSum of each group, {key: [(state,
+        # county), ...]}, in one pass over the counties CSV when streaming
+        if not self.streaming:
+            return ({region: self.getCounty(region[1], region[0], startDate) for region in regions},
+                    {key: self.getRegionsSum(regions=group, startDate=startDate) for key, group in groups.items()})
+        rows, sums = streamQueries(self.countiesChunks(), [regionSelector(regions=[region]) for region in regions],
+                                   [regionSelector(regions=group) for group in groups.values()], countiesDtype, startDate)
+        return dict(zip(regions, rows)), dict(zip(groups, sums))
+
+    def getGroupsSum(self, groups, startDate=None):
+        # Sums of several groups of counties, {name: [(state, county), ...]}
+        return self.queryCounties([], groups, startDate)[1]
+
+    def getState(self, name, startDate=None):
+        if self.streaming:
+            return streamRows(self.statesChunks(), regionSelector(states=[name]), statesDtype, startDate)
+        data = self.statesData[self.stateRows(name)]
+        if startDate:
+            data = data[np.searchsorted(data['date'], np.datetime64(startDate)):]
+        return decodeRows(data, self.statesTables, statesDtype)
+
+    @instrument(countRows=True)
+    def getStatesSum(self, states=None, startDate=None):
+        if self.streaming:
+            return streamSumsByDate(self.statesChunks(), [regionSelector(states=states or None)], startDate)[0]
+        idx = None
+        if states:
+            idx = np.concatenate([self.stateRows(state) for state in states])
+        return sumByDate(self.statesData, self.statesDates, self.statesDateIdx, idx, startDate)
+
+    def getCounty(self, county, state, startDate=None):
+        if self.streaming:
+            return streamRows(self.countiesChunks(), regionSelector(regions=[(state, county)]), countiesDtype, startDate)
+        data = self.countiesData[self.countyRows(county, state)]
+        if startDate:
+            data = data[np.searchsorted(data['date'], np.datetime64(startDate)):]
+        return decodeRows(data, self.countiesTables, countiesDtype)
+
+    @instrument(countRows=True)
+    def getCountiesSum(self, counties, state, startDate=None):
+        return self.getRegionsSum(regions=[(state, county) for county in counties], startDate=startDate)
+
+    @instrument(countRows=True)
+    def getRegionsSum(self, regions=None, fips=None, startDate=None):
+        # Sum any set of counties, given as (state, county) pairs and/or FIPS codes
+        if self.streaming:
+            return streamSumsByDate(self.countiesChunks(), [regionSelector(regions=regions or [], fips=fips)], startDate)[0]
+        idx = [np.zeros(0, dtype=np.intp)]
+        if regions:
+            idx += [self.countyRows(county, state) for state, county in regions]
+        if fips is not None and len(fips):
+            idx.append(np.flatnonzero(np.isin(self.countiesData['fips'], fips)))
+        # Each row counts once even if its county is selected more than once
+        idx = np.unique(np.concatenate(idx))
+        return sumByDate(self.countiesData, self.countiesDates, self.countiesDateIdx, idx, startDate)
+
+    def newCases(self, data):
+        return newCases(data)
+
+    def dailyDeaths(self, data):
+        return dailyDeaths(data)
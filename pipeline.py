@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+import os
+import ast
+import sys
+import json
+import time
+import hashlib
+import subprocess
+
+
+class Stage(object):
+    # One step of the data refresh: a script run with arguments, the files it reads and
+    # the files it writes. A stage is skipped when its inputs hash the same as on its
+    # last successful run and all of its outputs exist. Volatile stages (e.g. scraping a
+    # website) always run.
+    def __init__(self, name, command, inputs, outputs, volatile=False):
+        self.name = name
+        self.command = command
+        self.inputs = inputs
+        self.outputs = outputs
+        self.volatile = volatile
+
+
+class Pipeline(object):
+    def __init__(self, stages, stateFilename):
+        self.stages = stages
+        self.stateFilename = stateFilename
+        self.state = {'files': {}, 'stages': {}}
+        if os.path.exists(stateFilename):
+            with open(stateFilename, 'rt') as f:
+                self.state = json.load(f)
+
+    def saveState(self):
+        with open(self.stateFilename, 'wt') as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+
+    def fileHash(self, filename):
+        # Content hash, recomputed only when the file's size or mtime changed
+        if not os.path.exists(filename):
+            return None
+        stat = os.stat(filename)
+        cached = self.state['files'].get(filename)
+        if cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+            return cached['hash']
+        h = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        self.state['files'][filename] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': h.hexdigest()}
+        return h.hexdigest()
+
+    def inputsHash(self, stage):
+        h = hashlib.sha1(json.dumps(stage.command).encode('utf-8'))
+        for filename in stage.inputs:
+            h.update(f'{filename}:{self.fileHash(filename)}\n'.encode('utf-8'))
+        return h.hexdigest()
+
+    def isCurrent(self, stage):
+        if stage.volatile:
+            return False
+        if not all(os.path.exists(filename) for filename in stage.outputs):
+            return False
+        return self.state['stages'].get(stage.name) == self.inputsHash(stage)
+
+    def run(self, force=False, only=None, skipVolatile=False, reportPath=None, profile=False):
+        # With reportPath, each stage that runs writes its instrumentation report to
+        # <reportPath>/<stage>.json (and cProfile dumps to <reportPath>/profiles), and the
+        # status and time of every stage goes to <reportPath>/run.json. These arguments are
+        # not part of the stage command, so they do not change its hash.
+        summary = {}
+        for stage in self.stages:
+            if only and stage.name not in only:
+                continue
+            if stage.volatile and skipVolatile:
+                print(f'[{stage.name}] skipped')
+                summary[stage.name] = {'status': 'skipped'}
+                continue
+            if not force and self.isCurrent(stage):
+                print(f'[{stage.name}] up to date')
+                summary[stage.name] = {'status': 'up to date'}
+                continue
+            command = stage.command
+            if reportPath:
+                command = command + ['--report', os.path.join(reportPath, f'{stage.name}.json')]
+                if profile:
+                    command = command + ['--profile', os.path.join(reportPath, 'profiles')]
+            print(f'[{stage.name}] running {" ".join(command)}')
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + command, check=True)
+            self.state['stages'][stage.name] = self.inputsHash(stage)
+            self.saveState()
+            wall = time.perf_counter() - start
+            summary[stage.name] = {'status': 'ran', 'wall': wall}
+            print(f'[{stage.name}] done in {wall:.1f} s')
+        self.saveState()
+        if reportPath:
+            os.makedirs(reportPath, exist_ok=True)
+            with open(os.path.join(reportPath, 'run.json'), 'wt') as f:
+                json.dump(summary, f, indent=1)
+
+
+def localModules(script):
+    # The script and every module of this repository that it imports, directly or through
+    # other modules, so that a change to any of them triggers a rebuild
+    here = os.path.dirname(os.path.abspath(script))
+    found, pending = set(), [os.path.abspath(script)]
+    while pending:
+        filename = pending.pop()
+        if filename in found:
+            continue
+        found.add(filename)
+        with open(filename, 'rt') as f:
+            tree = ast.parse(f.read(), filename)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module = os.path.join(here, name.split('.')[0] + '.py')
+                if os.path.exists(module):
+                    pending.append(module)
+    return sorted(found)
+
+def defaultStages(dataPath, plotsPath):
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = lambda name: os.path.join(here, name)
+    nytPath = os.path.join(dataPath, 'nytimes')
+    population = os.path.join(dataPath, 'population.csv')
+    return [
+        Stage('cdph', [script('getCdphData.py'), '--dataPath', dataPath], localModules(script('getCdphData.py')),
+              [os.path.join(dataPath, 'califData.sqlite'), os.path.join(dataPath, 'califData.csv')], volatile=True),
+        Stage('nytPlots', [script('plotNytData.py'), '--dataPath', dataPath, '--plotsPath', plotsPath, '--noPlot'],
+              [os.path.join(nytPath, 'us-counties.csv'), os.path.join(nytPath, 'us-states.csv'), population] + localModules(script('plotNytData.py')),
+              [os.path.join(plotsPath, 'nyt_us_cases.png'), os.path.join(plotsPath, 'nyt_ca_cases.png')]),
+        Stage('cdphPlots', [script('plotCdphData.py'), '--dataPath', dataPath, '--plotsPath', plotsPath, '--noPlot'],
+              [os.path.join(dataPath, 'califData.sqlite'), population] + localModules(script('plotCdphData.py')),
+              [os.path.join(plotsPath, 'cdph_ca_cases.png'), os.path.join(plotsPath, 'cdph_ca_tests.png')]),
+    ]
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Refresh the data and plots, skipping stages whose inputs have not changed')
+    parser.add_argument('--dataPath', default='./data')
+    parser.add_argument('--plotsPath', default='./plots')
+    parser.add_argument('--force', action='store_true', help='Run every stage')
+    parser.add_argument('--offline', action='store_true', help='Skip stages that need the network (the CDPH scraper)')
+    parser.add_argument('--stage', action='append', default=None, help='Only run this stage (may be repeated)')
+    parser.add_argument('--reportPath', default=None, help='Directory for the timing and memory report of each stage')
+    parser.add_argument('--profile', action='store_true', help='Also write cProfile dumps of each stage to <reportPath>/profiles')
+    args = parser.parse_args()
+    if args.profile and not args.reportPath:
+        parser.error('--profile requires --reportPath')
+
+    pipeline = Pipeline(defaultStages(args.dataPath, args.plotsPath), os.path.join(args.dataPath, 'pipeline.json'))
+    pipeline.run(force=args.force, only=args.stage, skipVolatile=args.offline, reportPath=args.reportPath, profile=args.profile)
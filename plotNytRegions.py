@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+
+import numpy as np
+import matplotlib.dates
+import matplotlib.pyplot as plt
+
+from plotCdphData import savePlot
+from nytData import NytData
+from plotNytData import startDate
+from renderPool import renderFigures
+from timeSeries import rollingMean, dailyChange
+
+
+# Bump when the charts change so that every region is redrawn
+chartVersion = '1'
+
+def regionName(label):
+    return label['county'] if 'county' in label.dtype.names else label['state']
+
+def regionFilename(label):
+    name = '_'.join(str(label[field]) for field in label.dtype.names if field != 'fips')
+    return ''.join(c if c.isalnum() else '_' for c in name) + '.png'
+
+def regionHash(cube, row):
+    h = hashlib.sha1(chartVersion.encode('utf-8'))
+    for values in [cube.dates, cube.cases[row], cube.deaths[row]]:
+        h.update(np.ascontiguousarray(values).tobytes())
+    return h.hexdigest()
+
+
+class RegionChart(object):
+    # One figure reused for every region: only the line data, limits and title change
+    def __init__(self):
+        self.fig, self.axes = plt.subplots(3, sharex=True, figsize=(6, 8))
+        self.lines = []
+        for ax, title in zip(self.axes, ['Cases', 'New Cases', 'Daily Deaths']):
+            self.lines.append((ax.plot([], [], '.-')[0], ax.plot([], [], color='k', linestyle=':')[0]))
+            ax.set_title(title)
+            ax.xaxis_date()
+        self.axes[0].set_yscale('log')
+        self.fig.autofmt_xdate()
+        self.fig.subplots_adjust(left=0.13, bottom=0.08, right=0.95, top=0.91, hspace=0.2)
+
+    def draw(self, title, dates, cases, deaths):
+        x = matplotlib.dates.date2num(dates.astype('datetime64[D]').astype(object))
+        series = [cases, dailyChange(cases), dailyChange(deaths)]
+        for i, ((line, averageLine), values) in enumerate(zip(self.lines, series)):
+            line.set_data(x, values)
+            # Centered 7-day average of the daily series, as in plotNytData.py
+            if i > 0:
+                averageLine.set_data(x, rollingMean(values))
+        for ax in self.axes:
+            ax.relim()
+            ax.autoscale_view()
+        self.fig.suptitle(title)
+
+
+class GridChart(object):
+    # Small multiples of new cases, rows x columns regions per page, reused for every page
+    def __init__(self, rows, columns):
+        self.fig, axes = plt.subplots(rows, columns, sharex=True, figsize=(3*columns, 2.2*rows), squeeze=False)
+        self.axes = axes.ravel()
+        self.lines = []
+        for ax in self.axes:
+            self.lines.append((ax.plot([], [], linewidth=0.8)[0], ax.plot([], [], color='k', linewidth=1.2)[0]))
+            ax.xaxis_date()
+            ax.tick_params(labelsize=7)
+        self.fig.autofmt_xdate()
+        self.fig.subplots_adjust(left=0.05, bottom=0.08, right=0.98, top=0.94, hspace=0.4, wspace=0.25)
+
+    def draw(self, title, dates, names, cases):
+        x = matplotlib.dates.date2num(dates.astype('datetime64[D]').astype(object))
+        newCases = dailyChange(cases)
+        averages = rollingMean(newCases)
+        for i, (ax, (line, averageLine)) in enumerate(zip(self.axes, self.lines)):
+            ax.set_visible(i < len(names))
+            if i >= len(names):
+                continue
+            line.set_data(x, newCases[i])
+            averageLine.set_data(x, averages[i])
+            ax.set_title(names[i], fontsize=9)
+            ax.relim()
+            ax.autoscale_view()
+        self.fig.suptitle(title)
+
+
+def plotRegions(data, plotsPath, rows):
+    cube = data['cube']
+    chart = RegionChart()
+    for row in rows:
+        label = cube.labels[row]
+        chart.draw(f"{regionName(label)} (NYT)", cube.dates, cube.cases[row], cube.deaths[row])
+        savePlot(chart.fig, plotsPath, regionFilename(label))
+    return chart.fig
+
+def plotGridPages(data, plotsPath, pages, gridRows, gridColumns):
+    cube = data['cube']
+    chart = GridChart(gridRows, gridColumns)
+    for page, rows in pages:
+        names = [regionName(label) for label in cube.labels[rows]]
+        chart.draw(f"{data['title']} - New Cases (NYT), page {page + 1}", cube.dates, names, cube.cases[rows])
+        savePlot(chart.fig, plotsPath, f'page_{page + 1:03d}.png')
+    return chart.fig
+
+def loadManifest(plotsPath, name):
+    filename = os.path.join(plotsPath, name)
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, 'rt') as f:
+        return json.load(f)
+
+def saveManifest(plotsPath, name, manifest):
+    with open(os.path.join(plotsPath, name), 'wt') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+def isCurrent(plotsPath, manifest, filename, digest):
+    return manifest.get(filename) == digest and os.path.exists(os.path.join(plotsPath, filename))
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Charts for every state, or every county of a state')
+    parser.add_argument('--dataPath', default='./data')
+    parser.add_argument('--plotsPath', default='./plots/regions')
+    parser.add_argument('--state', default=None, help='Plot every county of this state instead of every state')
+    parser.add_argument('--grid', default=None, help='Small-multiples pages of ROWSxCOLUMNS regions (e.g. 4x5) instead of one chart per region')
+    parser.add_argument('--force', action='store_true', help='Redraw regions whose data has not changed')
+    parser.add_argument('--processes', type=int, default=None, help='Number of rendering processes (default: all cores)')
+    args = parser.parse_args()
+
+    nytData = NytData(os.path.join(args.dataPath, 'nytimes'))
+    nytData.loadSource()
+
+    if args.state:
+        cube = nytData.getCube('counties')
+        cube = cube.select(np.flatnonzero(cube.labels['state'] == args.state), startDate)
+        title = args.state
+    else:
+        cube = nytData.getCube('states').select(startDate=startDate)
+        title = 'United States'
+    if not len(cube):
+        raise SystemExit(f'No regions found for {title}!')
+
+    plotsPath = os.path.join(args.plotsPath, ''.join(c if c.isalnum() else '_' for c in title))
+    os.makedirs(plotsPath, exist_ok=True)
+    # Data hash of every chart drawn, to skip regions that have not changed
+    manifestName = 'manifest-grid.json' if args.grid else 'manifest.json'
+    manifest = {} if args.force else loadManifest(plotsPath, manifestName)
+    digests = [regionHash(cube, row) for row in range(len(cube))]
+    processes = args.processes or os.cpu_count()
+
+    if args.grid:
+        gridRows, gridColumns = [int(n) for n in args.grid.lower().split('x')]
+        perPage = gridRows * gridColumns
+        pages, newManifest = [], {}
+        for page, start in enumerate(range(0, len(cube), perPage)):
+            rows = list(range(start, min(start + perPage, len(cube))))
+            filename = f'page_{page + 1:03d}.png'
+            # The layout is part of the hash, so a page is redrawn when the grid changes
+            pageKey = args.grid + ':' + ','.join(digests[row] for row in rows)
+            newManifest[filename] = hashlib.sha1(pageKey.encode('utf-8')).hexdigest()
+            if not isCurrent(plotsPath, manifest, filename, newManifest[filename]):
+                pages.append((page, rows))
+        jobs = [(plotGridPages, (plotsPath, pages[i::processes], gridRows, gridColumns)) for i in range(min(processes, len(pages)))]
+    else:
+        newManifest = {regionFilename(cube.labels[row]): digests[row] for row in range(len(cube))}
+        rows = [row for row in range(len(cube)) if not isCurrent(plotsPath, manifest, regionFilename(cube.labels[row]), digests[row])]
+        jobs = [(plotRegions, (plotsPath, rows[i::processes])) for i in range(min(processes, len(rows)))]
+
+    print(f'\n{title}: {len(newManifest)} charts, {len(newManifest) - sum(len(job[1][1]) for job in jobs)} unchanged')
+    if jobs:
+        renderFigures(jobs, {'cube': cube, 'title': title}, processes)
+    saveManifest(plotsPath, manifestName, newManifest)
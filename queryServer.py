@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import asyncio
+import collections
+import urllib.parse
+
+import numpy as np
+
+from nytData import NytData
+from getCdphData import CdphCovidData
+from derivedMetrics import DerivedMetrics, NytMetrics, CdphMetrics, defaultPopulation
+
+httpReasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+# Metrics that can be queried; the CDPH data also has the test counts
+metricNames = ['cases', 'deaths', 'newCases', 'dailyDeaths', 'cfr', 'casesPer100k', 'deathsPer100k'] + DerivedMetrics.windowMetrics
+cdphMetricNames = ['testsConducted', 'testsReceived', 'testsPending', 'casesPerTest']
+
+class QueryError(Exception):
+    pass
+
+
+class QueryData(object):
+    # The NYT and CDPH data loaded once, with their derived metrics. The NYT data is a
+    # submodule, so without it only the CDPH data is served.
+    def __init__(self, dataPath):
+        self.dataPath = dataPath
+        start = time.perf_counter()
+        self.nytData = None
+        population = defaultPopulation(dataPath)
+        self.metrics = {}
+        nytPath = os.path.join(dataPath, 'nytimes')
+        if all(os.path.exists(os.path.join(nytPath, name)) for name in ['us-counties.csv', 'us-states.csv']):
+            self.nytData = NytData(nytPath)
+            self.nytData.loadSource()
+            self.metrics['nyt'] = NytMetrics(self.nytData, population=population)
+        else:
+            print(f'WARNING - no NYT data in {nytPath}, serving the CDPH data only')
+        self.cdphData = CdphCovidData()
+        if any(os.path.exists(os.path.join(dataPath, name)) for name in ['califData.sqlite', 'califData.pickle']):
+            self.cdphData.loadData(dataPath)
+        else:
+            self.cdphData.loadCsv(dataPath)
+        self.metrics['cdph'] = CdphMetrics(self.cdphData, population=population)
+        self.sourceTimes = sourceTimes(dataPath)
+        self.loadTime = time.perf_counter() - start
+
+def sourceTimes(dataPath):
+    filenames = [os.path.join(dataPath, 'nytimes', 'us-counties.csv'), os.path.join(dataPath, 'nytimes', 'us-states.csv'),
+                 os.path.join(dataPath, 'califData.sqlite'), os.path.join(dataPath, 'califData.pickle'), os.path.join(dataPath, 'califData.csv')]
+    return {filename: os.path.getmtime(filename) for filename in filenames if os.path.exists(filename)}
+
+def parseRegions(values):
+    # 'US' or 'United States' (the whole country), 'California' or 'California/Alameda';
+    # several regions are summed, and must be all states or all counties
+    if not values or values in (['US'], ['United States']):
+        return None
+    pairs = [tuple(value.split('/', 1)) if '/' in value else (value, '') for value in values]
+    if len(pairs) == 1:
+        return pairs[0][0] if not pairs[0][1] else pairs[0]
+    if len(set(bool(county) for state, county in pairs)) > 1:
+        raise QueryError('Cannot sum states and counties together')
+    return tuple(sorted(set(pairs)))
+
+def parseDate(value):
+    try:
+        return np.datetime64(value, 'D')
+    except ValueError:
+        raise QueryError(f'Invalid date: {value}')
+
+def jsonValues(values):
+    return [None if np.isnan(value) else float(value) for value in values.tolist()]
+
+
+class QueryService(object):
+    # Answers the JSON queries from the data in memory. Responses are cached by query
+    # (keeping the cacheSize most recent) until the data is reloaded.
+    def __init__(self, dataPath, cacheSize=256):
+        self.dataPath = dataPath
+        self.cacheSize = cacheSize
+        self.cache = collections.OrderedDict()
+        self.data = QueryData(dataPath)
+        self.reloading = False
+        self.requests = 0
+        self.cacheHits = 0
+
+    def isStale(self):
+        return sourceTimes(self.dataPath) != self.data.sourceTimes
+
+    async def reloadIfStale(self):
+        # Reload in a thread, keep answering from the old data, then swap
+        if self.reloading or not self.isStale():
+            return False
+        self.reloading = True
+        try:
+            print('Source data changed, reloading ...')
+            self.data = await asyncio.get_running_loop().run_in_executor(None, QueryData, self.dataPath)
+            self.cache.clear()
+            print(f'Reloaded in {self.data.loadTime:.1f} s')
+        finally:
+            self.reloading = False
+        return True
+
+    async def watch(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reloadIfStale()
+            except Exception as e:
+                print(f'WARNING - reload failed: {type(e).__name__}: {e}')
+
+    def handle(self, target):
+        # Returns (status, JSON body bytes)
+        self.requests += 1
+        url = urllib.parse.urlsplit(target)
+        params = urllib.parse.parse_qs(url.query)
+        key = (url.path, tuple(sorted((name, tuple(values)) for name, values in params.items())))
+        if key in self.cache and url.path != '/status':
+            self.cacheHits += 1
+            self.cache.move_to_end(key)
+            return 200, self.cache[key]
+
+        handlers = {'/series': self.series, '/regions': self.regions, '/metrics': self.metricNames, '/status': self.status}
+        if url.path not in handlers:
+            return 404, json.dumps({'error': f'Unknown path: {url.path}'}).encode('utf-8')
+        try:
+            body = json.dumps(handlers[url.path](params)).encode('utf-8')
+        except (QueryError, ValueError) as e:
+            return 400, json.dumps({'error': str(e)}).encode('utf-8')
+        self.cache[key] = body
+        while len(self.cache) > self.cacheSize:
+            self.cache.popitem(last=False)
+        return 200, body
+
+    def series(self, params):
+        # /series?source=nyt|cdph&region=...&metric=cases,newCasesAverage&window=7&start=2020-03-01&end=2020-06-01
+        source = params.get('source', ['nyt'])[0]
+        if source == 'nyt' and not self.data.nytData:
+            raise QueryError('The NYT data is not available')
+        if source not in self.data.metrics:
+            raise QueryError(f'Unknown source: {source}')
+        metrics = self.data.metrics[source]
+        region = parseRegions(params.get('region')) if source == 'nyt' else 'California'
+        names = [name for value in params.get('metric', ['cases,deaths']) for name in value.split(',') if name]
+        known = metricNames + (cdphMetricNames if source == 'cdph' else [])
+        for name in names:
+            if name not in known:
+                raise QueryError(f'Unknown metric: {name}')
+        try:
+            window = int(params.get('window', [7])[0])
+        except ValueError:
+            raise QueryError(f'Invalid window: {params["window"][0]}')
+        if window < 1:
+            raise QueryError('The window must be at least 1 day')
+        dates = metrics.dates(region)
+        # Metrics are computed over the whole series, then cut to the date range, so
+        # rolling windows at the start of the range are complete
+        keep = np.ones(len(dates), dtype=bool)
+        if 'start' in params:
+            keep &= dates >= parseDate(params['start'][0])
+        if 'end' in params:
+            keep &= dates <= parseDate(params['end'][0])
+        output = {'source': source, 'region': params.get('region', ['US']) if source == 'nyt' else ['California'],
+                  'window': window, 'dates': np.datetime_as_string(dates[keep], unit='D').tolist(), 'metrics': {}}
+        for name in names:
+            output['metrics'][name] = jsonValues(metrics.get(region, name, window)[keep])
+        return output
+
+    def regions(self, params):
+        # /regions lists the states, /regions?state=California its counties
+        nytData = self.data.nytData
+        if not nytData:
+            raise QueryError('The NYT data is not available')
+        if 'state' not in params:
+            return {'states': sorted(nytData.statesTables['state'][list(nytData.statesIndex)].tolist())}
+        state = params['state'][0]
+        numCounties = len(nytData.countiesTables['county'])
+        code = nytData.countiesStateCodes.get(state)
+        counties = [nytData.countiesTables['county'][key % numCounties] for key in nytData.countiesIndex if key // numCounties == code]
+        return {'state': state, 'counties': sorted(str(county) for county in counties)}
+
+    def metricNames(self, params):
+        return {'metrics': metricNames, 'cdphOnly': cdphMetricNames}
+
+    def status(self, params):
+        return {'loadTime': self.data.loadTime, 'sources': self.data.sourceTimes, 'requests': self.requests,
+                'cacheEntries': len(self.cache), 'cacheHits': self.cacheHits}
+
+    async def serveClient(self, reader, writer):
+        # Minimal HTTP/1.1: GET only, keep-alive unless the client asks to close
+        try:
+            while True:
+                requestLine = await reader.readline()
+                if not requestLine.strip():
+                    break
+                method, target, version = requestLine.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                if method != 'GET':
+                    status, body = 405, json.dumps({'error': f'Method not allowed: {method}'}).encode('utf-8')
+                else:
+                    try:
+                        status, body = self.handle(target)
+                    except Exception as e:
+                        status, body = 500, json.dumps({'error': f'{type(e).__name__}: {e}'}).encode('utf-8')
+                close = headers.get('connection', '').lower() == 'close' or version == 'HTTP/1.0'
+                writer.write((f'HTTP/1.1 {status} {httpReasons[status]}\r\nContent-Type: application/json\r\n'
+                              f'Content-Length: {len(body)}\r\nConnection: {"close" if close else "keep-alive"}\r\n\r\n').encode('latin-1') + body)
+                await writer.drain()
+                if close:
+                    break
+        except (ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port, reloadInterval=5):
+        server = await asyncio.start_server(self.serveClient, host, port)
+        print(f'Serving on http://{host}:{port} (data loaded in {self.data.loadTime:.1f} s)')
+        if reloadInterval:
+            asyncio.get_running_loop().create_task(self.watch(reloadInterval))
+        async with server:
+            await server.serve_forever()
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve the NYT and CDPH data as JSON queries from memory')
+    parser.add_argument('--dataPath', default='./data')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--cacheSize', type=int, default=256, help='Number of responses kept in the response cache')
+    parser.add_argument('--reloadInterval', type=float, default=5, help='Seconds between checks of the source files (0 disables reloading)')
+    args = parser.parse_args()
+
+    service = QueryService(args.dataPath, args.cacheSize)
+    try:
+        asyncio.run(service.serve(args.host, args.port, args.reloadInterval))
+    except KeyboardInterrupt:
+        pass
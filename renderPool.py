@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib.pyplot as plt
+
+from instrumentation import takeRecords, addRecords
+
+
+# Data shared by all figure jobs in a worker process
+sharedData = None
+
+def initWorker(shared):
+    global sharedData
+    plt.switch_backend('Agg')
+    sharedData = shared
+
+def initPoolWorker(shared):
+    # Forked workers start with a copy of the parent's spans; drop them so each job only
+    # returns its own
+    takeRecords()
+    initWorker(shared)
+
+def runJob(job):
+    # A job is (function, args): function(shared, *args) builds one figure, saves it with
+    # savePlot and returns it. Returns the instrumentation spans recorded by the job.
+    function, args = job
+    fig = function(sharedData, *args)
+    plt.close(fig)
+    return takeRecords()
+
+def renderFigures(jobs, shared=None, processes=None):
+    # Render independent figure jobs in a process pool on the non-interactive Agg backend.
+    # With the fork start method the workers inherit shared instead of unpickling a copy.
+    processes = min(processes or os.cpu_count(), len(jobs))
+    if processes <= 1:
+        initWorker(shared)
+        for job in jobs:
+            addRecords(runJob(job))
+        return
+
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    with ProcessPoolExecutor(processes, mp_context=context, initializer=initPoolWorker, initargs=(shared,)) as executor:
+        for future in [executor.submit(runJob, job) for job in jobs]:
+            addRecords(future.result())
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import datetime
+
+import numpy as np
+
+
+# Bump when the generated data changes so that existing datasets are rewritten
+generatorVersion = '1'
+
+# At scale 1, about the size of the NYT files in June 2020: ~55 states and territories,
+# ~3200 counties, ~150 days
+states = ['Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California', 'Colorado', 'Connecticut', 'Delaware',
+          'District of Columbia', 'Florida', 'Georgia', 'Guam', 'Hawaii', 'Idaho', 'Illinois', 'Indiana', 'Iowa',
+          'Kansas', 'Kentucky', 'Louisiana', 'Maine', 'Maryland', 'Massachusetts', 'Michigan', 'Minnesota',
+          'Mississippi', 'Missouri', 'Montana', 'Nebraska', 'Nevada', 'New Hampshire', 'New Jersey', 'New Mexico',
+          'New York', 'North Carolina', 'North Dakota', 'Northern Mariana Islands', 'Ohio', 'Oklahoma', 'Oregon',
+          'Pennsylvania', 'Puerto Rico', 'Rhode Island', 'South Carolina', 'South Dakota', 'Tennessee', 'Texas',
+          'Utah', 'Vermont', 'Virgin Islands', 'Virginia', 'Washington', 'West Virginia', 'Wisconsin', 'Wyoming']
+countiesPerState = 58
+days = 150
+firstDate = datetime.date(2020, 1, 21)
+bayAreaCounties = ['Alameda', 'Contra Costa', 'San Francisco', 'San Mateo', 'Santa Clara']
+
+def isCurrent(path, parameters):
+    filename = os.path.join(path, 'synthetic.json')
+    if not os.path.exists(filename):
+        return False
+    with open(filename, 'rt') as f:
+        return json.load(f) == parameters
+
+def markCurrent(path, parameters):
+    with open(os.path.join(path, 'synthetic.json'), 'wt') as f:
+        json.dump(parameters, f)
+
+def writeNytCsvs(path, scale=1, seed=0, force=False):
+    # us-counties.csv and us-states.csv in the NYT format with scale times the counties.
+    # Counties start reporting on staggered days, some have no FIPS code, and cumulative
+    # counts sometimes drop (revisions), as in the real data.
+    parameters = {'version': generatorVersion, 'scale': scale, 'seed': seed}
+    if not force and isCurrent(path, parameters):
+        return
+    os.makedirs(path, exist_ok=True)
+    print(f'Writing synthetic NYT data ({scale}x) to {path} ...')
+    rng = np.random.default_rng(seed)
+    counties = []
+    for stateIdx, state in enumerate(states):
+        names = [f'County {i:05d}' for i in range(countiesPerState * scale)] + ['Unknown']
+        if state == 'California':
+            names = bayAreaCounties + ['Los Angeles'] + names
+        elif state == 'New York':
+            names = ['New York City'] + names
+        for countyIdx, county in enumerate(sorted(names)):
+            fips = '' if county in ['Unknown', 'New York City'] else f'{(stateIdx + 1) * 1000 + countyIdx % 1000:05d}'
+            counties.append((state, county, fips))
+    numCounties = len(counties)
+    countyState = np.array([states.index(state) for state, county, fips in counties])
+    firstDay = rng.integers(30, days - 10, numCounties)
+    newCases = rng.poisson(rng.uniform(1, 50, (numCounties, 1)), (numCounties, days))
+    newCases[rng.random((numCounties, days)) < 0.01] *= -1
+    active = np.arange(days)[None, :] >= firstDay[:, None]
+    newCases[~active] = 0
+    cases = np.cumsum(newCases, axis=1).clip(0)
+    deaths = np.cumsum(rng.binomial(np.maximum(newCases, 0), 0.02), axis=1)
+
+    prefixes = [f',{county},{state},{fips},' for state, county, fips in counties]
+    with open(os.path.join(path, 'us-counties.csv'), 'wt') as f:
+        f.write('date,county,state,fips,cases,deaths\n')
+        for day in range(days):
+            date = str(firstDate + datetime.timedelta(day))
+            rows = np.flatnonzero(active[:, day])
+            f.write(''.join([f'{date}{prefixes[i]}{cases[i, day]},{deaths[i, day]}\n' for i in rows]))
+    with open(os.path.join(path, 'us-states.csv'), 'wt') as f:
+        f.write('date,state,fips,cases,deaths\n')
+        for day in range(days):
+            date = str(firstDate + datetime.timedelta(day))
+            stateCases = np.bincount(countyState, weights=cases[:, day], minlength=len(states))
+            stateDeaths = np.bincount(countyState, weights=deaths[:, day], minlength=len(states))
+            reporting = np.bincount(countyState, weights=active[:, day], minlength=len(states)) > 0
+            for i in np.flatnonzero(reporting):
+                f.write(f'{date},{states[i]},{i + 1:02d},{int(stateCases[i])},{int(stateDeaths[i])}\n')
+    markCurrent(path, parameters)
+
+def releaseHtml(number, date, cases, deaths, tests, boilerplate):
+    # The release layouts the parser handles: the confirmed cases paragraph or a list of
+    # "# – Positive cases", and the test wording before and after 2020-05-17
+    if number % 3:
+        body = f'<p><span>{cases:,} confirmed cases</span> to date. Sadly, <b>there</b> have been {deaths} deaths.</p>'
+    else:
+        body = f'<ul><li><p>{cases:,} – Positive cases</p></li><li><p>{deaths} – Deaths</p></li></ul>'
+    if date < datetime.date(2020, 5, 17):
+        body += f'<p>Approximately {tests:,} tests had been conducted in California. At least {tests - 1000:,} results have been received and another 1,000 are pending.</p>'
+    else:
+        body += f'<p>There have been {tests:,} tests conducted in California.</p>'
+    return (f'<html><head><title>NR20-{number:03d}</title></head><body>{boilerplate}'
+            f'<div class="release"><p>Number: NR20-{number:03d}</p><p>Date: {date.strftime("%B %d, %Y")}</p>{body}</div>'
+            f'{boilerplate}</body></html>')
+
+def writeCdphCorpus(path, count=90, pageKiB=100, force=False):
+    # count release pages padded with navigation markup to about pageKiB each, like the
+    # real pages, as NR20-###.html
+    parameters = {'version': generatorVersion, 'count': count, 'pageKiB': pageKiB}
+    if not force and isCurrent(path, parameters):
+        return
+    os.makedirs(path, exist_ok=True)
+    print(f'Writing {count} synthetic CDPH releases to {path} ...')
+    link = '<li class="nav-item"><a href="/Programs/Pages/Topic{0}.aspx"><span>Topic {0}</span></a></li>'
+    links = ''.join(link.format(i) for i in range(pageKiB * 1024 // 2 // 90))
+    boilerplate = f'<div class="nav"><ul>{links}</ul></div>'
+    for i in range(count):
+        date = datetime.date(2020, 3, 4) + datetime.timedelta(i)
+        html = releaseHtml(11 + i, date, 50 + 1500 * i, 1 + 50 * i, 20000 + 25000 * i, boilerplate)
+        with open(os.path.join(path, f'NR20-{11 + i:03d}.html'), 'wt', encoding='utf-8') as f:
+            f.write(html)
+    markCurrent(path, parameters)
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Write synthetic NYT CSVs and CDPH release pages for benchmarking')
+    parser.add_argument('--workPath', default='./benchmarkData')
+    parser.add_argument('--scales', default='1,10,100', help='Comma separated NYT data scales')
+    parser.add_argument('--releases', type=int, default=90)
+    parser.add_argument('--force', action='store_true', help='Rewrite datasets that are already current')
+    args = parser.parse_args()
+
+    for scale in [int(scale) for scale in args.scales.split(',')]:
+        writeNytCsvs(os.path.join(args.workPath, f'nyt-{scale}x'), scale, force=args.force)
+    writeCdphCorpus(os.path.join(args.workPath, 'cdph'), args.releases, force=args.force)
@@ -0,0 +1,179 @@
+import os
+import sys
+import csv
+import json
+import shutil
+import asyncio
+import tempfile
+import unittest
+import collections
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from queryServer import QueryService
+from syntheticData import writeNytCsvs, states, countiesPerState, bayAreaCounties
+
+repoDataPath = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+
+def makeDataPath(path, nyt=True):
+    # Synthetic NYT data and the checked-in CDPH snapshot
+    if nyt:
+        writeNytCsvs(os.path.join(path, 'nytimes'))
+    shutil.copy(os.path.join(repoDataPath, 'califData.csv'), path)
+
+def readCsv(filename):
+    with open(filename, 'rt', newline='') as f:
+        return list(csv.DictReader(f))
+
+def sumByDate(rows, field, dates=()):
+    # Sums of several regions cover every date in the table, with zeros before they report
+    sums = collections.OrderedDict((date, 0) for date in dates)
+    for row in rows:
+        sums[row['date']] = sums.get(row['date'], 0) + int(row[field])
+    return sums
+
+
+class QueryServiceTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dataPath = tempfile.mkdtemp()
+        makeDataPath(cls.dataPath)
+        cls.service = QueryService(cls.dataPath)
+        cls.states = readCsv(os.path.join(cls.dataPath, 'nytimes', 'us-states.csv'))
+        cls.counties = readCsv(os.path.join(cls.dataPath, 'nytimes', 'us-counties.csv'))
+        cls.cdph = readCsv(os.path.join(cls.dataPath, 'califData.csv'))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dataPath)
+
+    def get(self, target, status=200):
+        responseStatus, body = self.service.handle(target)
+        self.assertEqual(responseStatus, status, body)
+        return json.loads(body)
+
+    def assertSeries(self, output, metric, expected):
+        self.assertEqual(output['dates'], list(expected))
+        self.assertEqual(output['metrics'][metric], [float(value) for value in expected.values()])
+
+    def testStateSeries(self):
+        output = self.get('/series?region=California&metric=cases,deaths,newCases')
+        rows = [row for row in self.states if row['state'] == 'California']
+        self.assertSeries(output, 'cases', sumByDate(rows, 'cases'))
+        self.assertSeries(output, 'deaths', sumByDate(rows, 'deaths'))
+        cases = output['metrics']['cases']
+        self.assertIsNone(output['metrics']['newCases'][0])
+        self.assertEqual(output['metrics']['newCases'][1:], [b - a for a, b in zip(cases, cases[1:])])
+
+    def testCountrySeries(self):
+        output = self.get('/series?metric=cases')
+        self.assertEqual(output['region'], ['US'])
+        self.assertSeries(output, 'cases', sumByDate(self.states, 'cases'))
+
+    def testCountySeries(self):
+        output = self.get('/series?region=California/Alameda&metric=cases,deaths')
+        rows = [row for row in self.counties if row['state'] == 'California' and row['county'] == 'Alameda']
+        self.assertSeries(output, 'cases', sumByDate(rows, 'cases'))
+        self.assertSeries(output, 'deaths', sumByDate(rows, 'deaths'))
+
+    def testRegionsSum(self):
+        regions = '&'.join(f'region=California/{county}' for county in bayAreaCounties)
+        output = self.get(f'/series?{regions}&metric=cases')
+        rows = [row for row in self.counties if row['state'] == 'California' and row['county'] in bayAreaCounties]
+        dates = sorted(set(row['date'] for row in self.counties))
+        self.assertSeries(output, 'cases', sumByDate(rows, 'cases', dates))
+
+        output = self.get('/series?region=California&region=New York&metric=deaths')
+        rows = [row for row in self.states if row['state'] in ['California', 'New York']]
+        dates = sorted(set(row['date'] for row in self.states))
+        self.assertSeries(output, 'deaths', sumByDate(rows, 'deaths', dates))
+
+    def testDateRange(self):
+        full = self.get('/series?region=California&metric=cases,newCasesAverage')
+        output = self.get('/series?region=California&metric=cases,newCasesAverage&start=2020-04-01&end=2020-04-30')
+        self.assertEqual(output['dates'][0], '2020-04-01')
+        self.assertEqual(output['dates'][-1], '2020-04-30')
+        # Rolling windows are computed before the range is cut
+        first = full['dates'].index('2020-04-01')
+        self.assertEqual(output['metrics']['newCasesAverage'], full['metrics']['newCasesAverage'][first:first+30])
+
+    def testCdphSeries(self):
+        output = self.get('/series?source=cdph&metric=cases,testsConducted')
+        self.assertEqual(output['region'], ['California'])
+        self.assertEqual(output['dates'], [row['date'] for row in self.cdph])
+        self.assertEqual(output['metrics']['cases'], [float(row['cases']) for row in self.cdph])
+        self.assertEqual(output['metrics']['testsConducted'],
+                         [float(row['testsConducted']) if row['testsConducted'] else None for row in self.cdph])
+
+    def testRegions(self):
+        self.assertEqual(self.get('/regions')['states'], sorted(states))
+        counties = self.get('/regions?state=California')['counties']
+        self.assertEqual(len(counties), countiesPerState + len(bayAreaCounties) + 2)
+        self.assertIn('Los Angeles', counties)
+        self.assertEqual(counties, sorted(counties))
+
+    def testBadRequests(self):
+        self.assertIn('bogus', self.get('/series?metric=cases,bogus', 400)['error'])
+        self.assertIn('testsConducted', self.get('/series?source=nyt&metric=testsConducted', 400)['error'])
+        self.assertIn('window', self.get('/series?metric=newCasesAverage&window=week', 400)['error'])
+        self.get('/series?metric=newCasesAverage&window=0', 400)
+        self.assertIn('date', self.get('/series?start=2020-13-01', 400)['error'])
+        self.get('/series?end=yesterday', 400)
+        self.get('/series?source=jhu', 400)
+        self.get('/series?region=California&region=California/Alameda', 400)
+        self.get('/nothing', 404)
+
+    def testResponseCache(self):
+        target = '/series?region=California/San Mateo&metric=newCasesAverage&window=14'
+        hits = self.service.cacheHits
+        first = self.service.handle(target)
+        second = self.service.handle(target)
+        self.assertEqual(first, second)
+        self.assertEqual(self.service.cacheHits, hits + 1)
+        # Errors are not cached
+        self.service.handle('/series?metric=bogus')
+        self.service.handle('/series?metric=bogus')
+        self.assertEqual(self.service.cacheHits, hits + 1)
+
+
+class ReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.dataPath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dataPath)
+
+    def testReloadIfStale(self):
+        makeDataPath(self.dataPath)
+        service = QueryService(self.dataPath)
+        target = '/series?source=cdph&metric=cases'
+        before = json.loads(service.handle(target)[1])
+        self.assertFalse(asyncio.run(service.reloadIfStale()))
+
+        filename = os.path.join(self.dataPath, 'califData.csv')
+        with open(filename, 'at') as f:
+            f.write('2020-06-08,NR20-117,131319,4697,,,\n')
+        mtime = os.path.getmtime(filename) + 10
+        os.utime(filename, (mtime, mtime))
+        self.assertTrue(service.isStale())
+        self.assertTrue(asyncio.run(service.reloadIfStale()))
+        self.assertEqual(len(service.cache), 0)
+        after = json.loads(service.handle(target)[1])
+        self.assertEqual(after['dates'], before['dates'] + ['2020-06-08'])
+        self.assertEqual(after['metrics']['cases'][-1], 131319)
+        self.assertFalse(asyncio.run(service.reloadIfStale()))
+
+    def testWithoutNytData(self):
+        makeDataPath(self.dataPath, nyt=False)
+        service = QueryService(self.dataPath)
+        self.assertIn('NYT', json.loads(service.handle('/series?metric=cases')[1])['error'])
+        self.assertEqual(service.handle('/series?source=nyt&region=California')[0], 400)
+        self.assertEqual(service.handle('/regions')[0], 400)
+        status, body = service.handle('/series?source=cdph&metric=cases')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['metrics']['cases'][0], 53)
+
+
+if __name__=='__main__':
+    unittest.main()
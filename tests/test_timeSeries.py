@@ -0,0 +1,121 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal, assert_allclose
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from timeSeries import rollingSum, rollingMean, interpolateGaps, dailyChange, trimEdges
+
+nan = np.nan
+
+
+class InterpolateGapsTest(unittest.TestCase):
+    def testInteriorRuns(self):
+        assert_allclose(interpolateGaps([1, nan, 3]), [1, 2, 3])
+        assert_allclose(interpolateGaps([0, nan, nan, nan, 8, nan, 4]), [0, 2, 4, 6, 8, 6, 4])
+
+    def testLeadingAndTrailingRuns(self):
+        assert_array_equal(interpolateGaps([nan, nan, 5, 7]), [5, 5, 5, 7])
+        assert_array_equal(interpolateGaps([2, 4, nan, nan]), [2, 4, 4, 4])
+        assert_array_equal(interpolateGaps([nan, 3, nan]), [3, 3, 3])
+
+    def testNoGaps(self):
+        assert_array_equal(interpolateGaps([1, 5, 2]), [1, 5, 2])
+
+    def testAllNan(self):
+        assert_array_equal(interpolateGaps([nan, nan, nan]), [nan, nan, nan])
+
+    def test2d(self):
+        values = [[1, nan, nan, 4],
+                  [nan, nan, nan, nan],
+                  [nan, 2, nan, nan]]
+        assert_allclose(interpolateGaps(values), [[1, 2, 3, 4],
+                                                  [nan, nan, nan, nan],
+                                                  [2, 2, 2, 2]])
+
+    def testInputUnchanged(self):
+        values = np.array([1, nan, 3])
+        interpolateGaps(values)
+        assert_array_equal(values, [1, nan, 3])
+
+
+class RollingTest(unittest.TestCase):
+    values = np.arange(1, 8, dtype=float)
+
+    def testCenteredMean(self):
+        assert_array_equal(rollingMean(self.values, 3), [nan, 2, 3, 4, 5, 6, nan])
+        assert_array_equal(rollingMean(self.values, 4), [nan, nan, 2.5, 3.5, 4.5, 5.5, nan])
+
+    def testTrailingMean(self):
+        assert_array_equal(rollingMean(self.values, 3, 'trailing'), [nan, nan, 2, 3, 4, 5, 6])
+
+    def testSums(self):
+        assert_array_equal(rollingSum(self.values, 3), [nan, 6, 9, 12, 15, 18, nan])
+        assert_array_equal(rollingSum(self.values, 3, 'trailing'), [nan, nan, 6, 9, 12, 15, 18])
+
+    def testUnknownAlignment(self):
+        with self.assertRaises(ValueError):
+            rollingMean(self.values, 3, 'leading')
+
+    def testMissingValues(self):
+        values = [1, nan, 3, 4, nan, nan, nan]
+        # By default a window needs all n values
+        assert_array_equal(rollingMean(values, 3, 'trailing'), [nan] * 7)
+        assert_array_equal(rollingMean(values, 3, 'trailing', minCount=2), [nan, nan, 2, 3.5, 3.5, nan, nan])
+        assert_array_equal(rollingMean(values, 3, 'trailing', minCount=1), [nan, nan, 2, 3.5, 3.5, 4, nan])
+        assert_array_equal(rollingSum(values, 3, 'trailing', minCount=1), [nan, nan, 4, 7, 7, 4, nan])
+        # minCount=0 keeps empty windows: their sum is 0 and their mean is undefined
+        assert_array_equal(rollingSum(values, 3, 'trailing', minCount=0), [nan, nan, 4, 7, 7, 4, 0])
+        assert_array_equal(rollingMean(values, 3, 'trailing', minCount=0), [nan, nan, 2, 3.5, 3.5, 4, nan])
+
+    def testWindowLongerThanSeries(self):
+        for align in ['centered', 'trailing']:
+            assert_array_equal(rollingMean([1, 2, 3], 7, align), [nan, nan, nan])
+            assert_array_equal(rollingSum([1, 2, 3], 7, align, minCount=0), [nan, nan, nan])
+        assert_array_equal(rollingMean([1, 2, 3], 3, 'trailing'), [nan, nan, 2])
+
+    def test2d(self):
+        values = np.array([self.values, self.values * 10])
+        assert_array_equal(rollingMean(values, 3), [[nan, 2, 3, 4, 5, 6, nan], [nan, 20, 30, 40, 50, 60, nan]])
+
+
+class DailyChangeTest(unittest.TestCase):
+    def testChange(self):
+        assert_array_equal(dailyChange([1, 3, 6, 5, 8]), [nan, 2, 3, -1, 3])
+
+    def testClampNegative(self):
+        assert_array_equal(dailyChange([1, 3, 6, 5, 8], clampNegative=True), [nan, 2, 3, 0, 3])
+
+    def test2d(self):
+        assert_array_equal(dailyChange([[1, 0, 4], [2, 2, 5]], clampNegative=True), [[nan, 0, 4], [nan, 0, 3]])
+
+
+class TrimEdgesTest(unittest.TestCase):
+    dates = np.arange('2020-03-01', '2020-03-07', dtype='datetime64[D]')
+
+    def testTrim(self):
+        dates, values = trimEdges(self.dates, [nan, nan, 1, nan, 2, nan])
+        assert_array_equal(dates, self.dates[2:5])
+        assert_array_equal(values, [1, nan, 2])
+
+    def test2dKeepsDatesWithAnyValue(self):
+        dates, values = trimEdges(self.dates, [[nan, 1, nan, nan, nan, nan], [nan, nan, nan, 2, nan, nan]])
+        assert_array_equal(dates, self.dates[1:4])
+        assert_array_equal(values, [[1, nan, nan], [nan, nan, 2]])
+
+    def testAllNan(self):
+        dates, values = trimEdges(self.dates, [[nan] * 6, [nan] * 6])
+        self.assertEqual(len(dates), 0)
+        self.assertEqual(values.shape, (2, 0))
+
+    def testNothingToTrim(self):
+        dates, values = trimEdges(self.dates, np.arange(6))
+        assert_array_equal(dates, self.dates)
+        assert_array_equal(values, np.arange(6))
+
+
+if __name__=='__main__':
+    unittest.main()
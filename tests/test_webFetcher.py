@@ -0,0 +1,194 @@
+import os
+import sys
+import time
+import shutil
+import datetime
+import tempfile
+import threading
+import unittest
+import collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from webFetcher import Fetcher, ResponseCache
+from getCdphData import CdphCovidData
+from syntheticData import releaseHtml
+
+
+releaseNumbers = [11, 12, 13, 14]
+missingRelease = 15
+indexPath = '/Programs/OPA/Pages/New-Release-2020.aspx'
+
+def releasePath(number):
+    return f'/Programs/OPA/Pages/NR20-{number:03d}.aspx'
+
+def releasePage(number):
+    # Release 12 uses the "1,550 – Positive cases" layout, whose en dash is only read
+    # correctly if the page is decoded as UTF-8
+    date = datetime.date(2020, 3, 4) + datetime.timedelta(number)
+    return releaseHtml(number, date, 50 + 1500 * number, 1 + 50 * number, 20000 + 25000 * number, '').encode('utf-8')
+
+def indexPage():
+    links = ''.join(f'<a href="{releasePath(number)}"><span>Latest COVID-19 Facts</span></a>' for number in releaseNumbers + [missingRelease])
+    return f'<html><body>{links}</body></html>'.encode('utf-8')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # A local stand-in for the CDPH website. Pages are sent as text/html without a
+    # charset, like a plain http.server mirror. /slow/* pages take a while, /flaky fails
+    # twice before it works, /broken always fails and /etag answers conditional GETs.
+    hits = collections.Counter()
+    inFlight = 0
+    maxInFlight = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.hits[self.path] += 1
+            cls.inFlight += 1
+            cls.maxInFlight = max(cls.maxInFlight, cls.inFlight)
+            hits = cls.hits[self.path]
+        try:
+            if self.path.startswith('/slow/'):
+                time.sleep(0.2)
+                self.send(200, self.path.encode('utf-8'))
+            elif self.path == '/flaky':
+                self.send(503 if hits <= 2 else 200, b'flaky')
+            elif self.path == '/broken':
+                self.send(500, b'broken')
+            elif self.path == '/etag':
+                if self.headers.get('If-None-Match') == '"v1"':
+                    self.send(304, b'')
+                else:
+                    self.send(200, b'etag page', {'ETag': '"v1"'})
+            elif self.path == indexPath:
+                self.send(200, indexPage())
+            elif self.path in [releasePath(number) for number in releaseNumbers]:
+                self.send(200, releasePage(int(self.path[-8:-5])))
+            else:
+                self.send(404, b'not found')
+        finally:
+            with cls.lock:
+                cls.inFlight -= 1
+
+    def send(self, status, body, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetcherTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        cls.baseUrl = f'http://127.0.0.1:{cls.server.server_address[1]}'
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StandInHandler.hits.clear()
+        StandInHandler.maxInFlight = 0
+        self.tempPath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempPath)
+
+    def url(self, path):
+        return self.baseUrl + path
+
+    def testConcurrentFetch(self):
+        fetcher = Fetcher(maxWorkers=4, requestsPerSecond=0)
+        urls = [self.url(f'/slow/{i}') for i in range(8)]
+        start = time.perf_counter()
+        results = list(fetcher.getMany(urls))
+        elapsed = time.perf_counter() - start
+        fetcher.close()
+        self.assertEqual(sorted(url for url, response, error in results), sorted(urls))
+        for url, response, error in results:
+            self.assertIsNone(error)
+            self.assertEqual(response.text, url[len(self.baseUrl):])
+        self.assertGreater(StandInHandler.maxInFlight, 1)
+        self.assertLessEqual(StandInHandler.maxInFlight, 4)
+        self.assertLess(elapsed, 8 * 0.2)
+        self.assertEqual(fetcher.requests, 8)
+
+    def testRetryOn5xx(self):
+        fetcher = Fetcher(requestsPerSecond=0, retries=3, backoff=0)
+        response = fetcher.get(self.url('/flaky'))
+        fetcher.close()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(StandInHandler.hits['/flaky'], 3)
+
+    def testBackoffBetweenRetries(self):
+        fetcher = Fetcher(requestsPerSecond=0, retries=3, backoff=0.1)
+        start = time.perf_counter()
+        fetcher.get(self.url('/flaky'))
+        elapsed = time.perf_counter() - start
+        fetcher.close()
+        # urllib3 sleeps backoff * 2**(retry - 1) before each retry after the first
+        self.assertGreaterEqual(elapsed, 0.2)
+
+    def testFailedDownloadIsReported(self):
+        fetcher = Fetcher(requestsPerSecond=0, retries=2, backoff=0)
+        urls = [self.url('/slow/1'), self.url('/broken'), self.url('/missing')]
+        results = {url: (response, error) for url, response, error in fetcher.getMany(urls)}
+        fetcher.close()
+        self.assertIsNone(results[self.url('/slow/1')][1])
+        self.assertIsNotNone(results[self.url('/broken')][1])
+        self.assertIsNotNone(results[self.url('/missing')][1])
+        self.assertEqual(StandInHandler.hits['/broken'], 3)
+        self.assertEqual(StandInHandler.hits['/missing'], 1)
+
+    def testNotModifiedServedFromCache(self):
+        cache = ResponseCache(os.path.join(self.tempPath, 'httpCache'))
+        fetcher = Fetcher(requestsPerSecond=0, cache=cache)
+        first = fetcher.get(self.url('/etag'))
+        second = fetcher.get(self.url('/etag'))
+        third = fetcher.get(self.url('/etag'), revalidate=False)
+        fetcher.close()
+        self.assertEqual(first.content, b'etag page')
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.content, b'etag page')
+        self.assertEqual(third.content, b'etag page')
+        # The second request was conditional and answered 304; the third never left the cache
+        self.assertEqual(StandInHandler.hits['/etag'], 2)
+        self.assertEqual(fetcher.requests, 2)
+
+        # The index is kept on disk as bodies are added, so a new cache sees the entry
+        reopened = ResponseCache(os.path.join(self.tempPath, 'httpCache'))
+        self.assertEqual(reopened.get(self.url('/etag')).content, b'etag page')
+
+    def testGetData(self):
+        fetcher = Fetcher(maxWorkers=4, requestsPerSecond=0, retries=1, backoff=0)
+        cdphData = CdphCovidData(self.baseUrl, fetcher=fetcher)
+        failures = cdphData.getData()
+        fetcher.close()
+        missingUrl = self.url(releasePath(missingRelease))
+        self.assertEqual(list(failures), [missingUrl])
+        self.assertEqual(sorted(cdphData.data), sorted(self.url(releasePath(number)) for number in releaseNumbers))
+        for number in releaseNumbers:
+            record = cdphData.data[self.url(releasePath(number))]
+            self.assertEqual(record['releaseNumber'], f'NR20-{number:03d}')
+            self.assertEqual(record['cases'], 50 + 1500 * number)
+            self.assertEqual(record['deaths'], 1 + 50 * number)
+        self.assertEqual(cdphData.getNewestRecord()['releaseNumber'], f'NR20-{releaseNumbers[-1]:03d}')
+
+
+if __name__=='__main__':
+    unittest.main()
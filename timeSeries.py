@@ -0,0 +1,76 @@
+import numpy as np
+
+# Time-series kernels for a 1-D series or a 2-D (region x date) batch, working along the
+# last axis. Results have the same length as the input, so they line up with the input
+# dates directly; values that cannot be computed (window edges, leading difference) are
+# NaN, which matplotlib leaves out of a line.
+
+def rollingWindow(values, n, align):
+    # NaN-skipping sums and counts of valid values over each n-day window, placed at the
+    # window's center (day n//2 of the window) or end (trailing)
+    values = np.asarray(values, dtype=float)
+    valid = ~np.isnan(values)
+    pad = np.zeros(values.shape[:-1] + (1,))
+    sums = np.concatenate([pad, np.cumsum(np.where(valid, values, 0), axis=-1)], axis=-1)
+    counts = np.concatenate([pad, np.cumsum(valid, axis=-1)], axis=-1)
+    if align == 'centered':
+        offset = n // 2
+    elif align == 'trailing':
+        offset = n - 1
+    else:
+        raise ValueError(f'Unknown window alignment: {align}')
+
+    windowSums = np.full(values.shape, np.nan)
+    windowCounts = np.zeros(values.shape)
+    numWindows = values.shape[-1] - n + 1
+    if numWindows > 0:
+        windowSums[..., offset:offset + numWindows] = sums[..., n:] - sums[..., :-n]
+        windowCounts[..., offset:offset + numWindows] = counts[..., n:] - counts[..., :-n]
+    return windowSums, windowCounts
+
+def rollingSum(values, n=7, align='centered', minCount=None):
+    # A window needs at least minCount valid values (default: all n)
+    sums, counts = rollingWindow(values, n, align)
+    return np.where(counts >= (n if minCount is None else minCount), sums, np.nan)
+
+def rollingMean(values, n=7, align='centered', minCount=None):
+    sums, counts = rollingWindow(values, n, align)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts >= (n if minCount is None else minCount), sums / counts, np.nan)
+
+def interpolateGaps(values):
+    # Linear interpolation across runs of NaN; leading and trailing runs take the nearest
+    # valid value. Series with no valid values stay NaN.
+    values = np.asarray(values, dtype=float)
+    length = values.shape[-1]
+    valid = ~np.isnan(values)
+    index = np.broadcast_to(np.arange(length), values.shape)
+    previous = np.maximum.accumulate(np.where(valid, index, -1), axis=-1)
+    following = np.minimum.accumulate(np.where(valid, index, length)[..., ::-1], axis=-1)[..., ::-1]
+    hasPrevious = previous >= 0
+    hasFollowing = following < length
+    previousValues = np.take_along_axis(values, np.clip(previous, 0, length - 1), axis=-1)
+    followingValues = np.take_along_axis(values, np.clip(following, 0, length - 1), axis=-1)
+    weight = (index - previous) / np.maximum(following - previous, 1)
+    interpolated = previousValues + (followingValues - previousValues) * weight
+    return np.where(hasPrevious & hasFollowing, interpolated, np.where(hasPrevious, previousValues, followingValues))
+
+def dailyChange(values, clampNegative=False):
+    # Day-over-day difference of a cumulative series, aligned with the later day. With
+    # clampNegative, downward revisions of the cumulative count become 0.
+    values = np.asarray(values, dtype=float)
+    change = np.full(values.shape, np.nan)
+    change[..., 1:] = np.diff(values, axis=-1)
+    if clampNegative:
+        change[change < 0] = 0
+    return change
+
+def trimEdges(dates, values):
+    # Drop the leading and trailing dates where every series is NaN
+    values = np.asarray(values, dtype=float)
+    valid = ~np.isnan(values).reshape(-1, values.shape[-1]).all(axis=0)
+    if not valid.any():
+        return dates[:0], values[..., :0]
+    first = np.argmax(valid)
+    last = len(valid) - np.argmax(valid[::-1])
+    return dates[first:last], values[..., first:last]
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import hashlib
+import threading
+import urllib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+
+
+class RateLimiter(object):
+    # Spaces out requests to the same host by at least 1/requestsPerSecond seconds
+    def __init__(self, requestsPerSecond):
+        self.interval = 1. / requestsPerSecond if requestsPerSecond else 0.
+        self.lock = threading.Lock()
+        self.nextTime = {}
+
+    def wait(self, host):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.nextTime.get(host, now))
+            self.nextTime[host] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class ResponseCache(object):
+    # On-disk cache of response bodies keyed by URL, with the validators (ETag and
+    # Last-Modified) needed for conditional GETs. When the bodies exceed maxBytes the
+    # least recently used entries are evicted.
+    def __init__(self, path, maxBytes=200*1024*1024):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.indexFilename = os.path.join(path, 'index.json')
+        self.lock = threading.Lock()
+        self.index = {}
+        if os.path.exists(self.indexFilename):
+            with open(self.indexFilename, 'rt') as f:
+                self.index = json.load(f)
+        # Bodies without an index entry (e.g. from a run that crashed before the index was
+        # written on every change) would never be evicted, so they are removed
+        if os.path.isdir(path):
+            indexed = {os.path.basename(self.bodyFilename(url)) for url in self.index}
+            for name in os.listdir(path):
+                if name.endswith('.body') and name not in indexed:
+                    os.remove(os.path.join(path, name))
+
+    def bodyFilename(self, url):
+        return os.path.join(self.path, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.body')
+
+    def get(self, url):
+        # Returns a response rebuilt from the cache, or None
+        with self.lock:
+            entry = self.index.get(url)
+            if entry is None:
+                return None
+            try:
+                with open(self.bodyFilename(url), 'rb') as f:
+                    body = f.read()
+            except OSError:
+                del self.index[url]
+                return None
+            entry['lastUsed'] = time.time()
+
+        response = requests.Response()
+        response._content = body
+        response.status_code = 200
+        response.url = url
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.encoding = entry['encoding']
+        return response
+
+    def validators(self, url):
+        entry = self.index.get(url)
+        if entry is None:
+            return {}
+        headers = {}
+        if 'etag' in entry['headers']:
+            headers['If-None-Match'] = entry['headers']['etag']
+        if 'last-modified' in entry['headers']:
+            headers['If-Modified-Since'] = entry['headers']['last-modified']
+        return headers
+
+    def put(self, url, response):
+        headers = {name.lower(): value for name, value in response.headers.items() if name.lower() in ['etag', 'last-modified', 'content-type']}
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(self.bodyFilename(url), 'wb') as f:
+                f.write(response.content)
+            self.index[url] = {'headers': headers, 'encoding': response.encoding, 'size': len(response.content), 'lastUsed': time.time()}
+            self.evict()
+            self.writeIndex()
+
+    def evict(self):
+        totalBytes = sum(entry['size'] for entry in self.index.values())
+        for url in sorted(self.index, key=lambda url: self.index[url]['lastUsed']):
+            if totalBytes <= self.maxBytes:
+                break
+            totalBytes -= self.index[url]['size']
+            del self.index[url]
+            try:
+                os.remove(self.bodyFilename(url))
+            except OSError:
+                pass
+
+    def writeIndex(self):
+        # Written after every body, so a crashed run leaves no unindexed bodies behind
+        temp = self.indexFilename + '.tmp'
+        with open(temp, 'wt') as f:
+            json.dump(self.index, f)
+        os.replace(temp, self.indexFilename)
+
+    def save(self):
+        # Stores the last-used times, which are not written on every cache hit
+        with self.lock:
+            if not self.index and not os.path.exists(self.path):
+                return
+            os.makedirs(self.path, exist_ok=True)
+            self.evict()
+            self.writeIndex()
+
+
+class Fetcher(object):
+    # Pooled, keep-alive HTTP session with retries and backoff, shared by a bounded
+    # pool of worker threads
+    def __init__(self, maxWorkers=4, requestsPerSecond=4, retries=3, backoff=0.5, timeout=30, cache=None):
+        self.maxWorkers = maxWorkers
+        self.cache = cache
+        # Network traffic so far, for instrumentation
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytesFetched = 0
+        self.timeout = timeout
+        self.rateLimiter = RateLimiter(requestsPerSecond)
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'])
+        adapter = HTTPAdapter(pool_connections=maxWorkers, pool_maxsize=maxWorkers, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, revalidate=True):
+        # With a cache, pages that do not change (revalidate=False) are served from it
+        # without touching the network; otherwise a conditional GET is sent and a
+        # 304 Not Modified is answered from the cache
+        headers = {}
+        if self.cache is not None:
+            if not revalidate:
+                response = self.cache.get(url)
+                if response is not None:
+                    return response
+            headers = self.cache.validators(url)
+
+        self.rateLimiter.wait(urllib.parse.urlsplit(url).netloc)
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+        self.count(response)
+        if response.status_code == 304 and self.cache is not None:
+            cached = self.cache.get(url)
+            if cached is not None:
+                return cached
+            response = self.session.get(url, timeout=self.timeout)
+            self.count(response)
+        response.raise_for_status()
+        if self.cache is not None:
+            self.cache.put(url, response)
+        return response
+
+    def count(self, response):
+        with self.lock:
+            self.requests += 1
+            self.bytesFetched += len(response.content)
+
+    def getMany(self, urls, revalidate=True):
+        # Yields (url, response, error) in completion order, so the caller can process each
+        # page while the rest are still being fetched
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            futures = {executor.submit(self.get, url, revalidate): url for url in urls}
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result(), None
+                except requests.RequestException as e:
+                    yield futures[future], None, e
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.save()
+        self.session.close()